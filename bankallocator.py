@@ -0,0 +1,91 @@
+import fcntl
+import json
+import random
+
+DEFAULT_DIGITS = 8  # including the check digit: 9,000,000 numbers
+BLOCK_SIZE = 64  # counter values reserved per trip to the state file
+ROUNDS = 4
+
+
+def luhn_digit(number):
+    # The check digit that makes number * 10 + digit pass the Luhn check.
+    total = 0
+    for position, digit in enumerate(reversed(str(number))):
+        if position % 2 == 0:
+            digit = int(digit) * 2
+            total += digit - 9 if digit > 9 else digit
+        else:
+            total += int(digit)
+    return (10 - total % 10) % 10
+
+def is_valid(account_number, digits=DEFAULT_DIGITS):
+    # Catches mistyped numbers (any single digit, most swaps) without a lookup.
+    text = str(account_number)
+    return len(text) == digits and luhn_digit(int(text[:-1])) == int(text[-1])
+
+
+class AccountNumberAllocator:
+    # Hands out unique account numbers in O(1): a shared counter is run
+    # through a keyed Feistel permutation, so consecutive accounts get
+    # unrelated-looking numbers, and a Luhn check digit is appended. The
+    # counter, key and width live in a small JSON state file shared by every
+    # process; each process reserves BLOCK_SIZE counter values at a time.
+    #
+    # digits only applies when the state file is created; a bank that needs
+    # wider numbers starts a new state file (old numbers stay valid).
+    def __init__(self, path, digits=DEFAULT_DIGITS):
+        self.path = path
+        self.digits = digits
+        self.key = None
+        self._next = self._stop = 0
+
+    def allocate(self):
+        if self._next == self._stop:
+            self._reserve()
+        index = self._next
+        self._next += 1
+        base = self._low + self._permute(index)
+        return base * 10 + luhn_digit(base)
+
+    def _reserve(self):
+        with open(self.path, "a+") as file:
+            fcntl.lockf(file, fcntl.LOCK_EX)
+            file.seek(0)
+            text = file.read()
+            state = json.loads(text) if text else {"digits": self.digits, "key": random.getrandbits(64), "next": 0}
+            self._configure(state["digits"], state["key"])
+            if state["next"] >= self._size:
+                raise OverflowError(f"All {self._size} {self.digits}-digit account numbers are used; "
+                                    f"start a wider allocator state file.")
+            self._next = state["next"]
+            self._stop = min(self._next + BLOCK_SIZE, self._size)
+            state["next"] = self._stop
+            file.truncate(0)
+            file.write(json.dumps(state))
+            file.flush()
+
+    def _configure(self, digits, key):
+        if self.key == key:
+            return
+        self.digits, self.key = digits, key
+        # Bases have digits - 1 digits and no leading zero.
+        self._low = 10 ** (digits - 2)
+        self._size = 9 * self._low
+        self._half_bits = (self._size.bit_length() + 1) // 2
+        self._half_mask = (1 << self._half_bits) - 1
+        rng = random.Random(key)
+        self._round_keys = [rng.getrandbits(32) for _ in range(ROUNDS)]
+
+    def _permute(self, index):
+        # The Feistel network permutes the smallest even-bit range holding
+        # every index; values past the end are fed through again (cycle
+        # walking), which stays a bijection on range(self._size).
+        value = index
+        while True:
+            left, right = value >> self._half_bits, value & self._half_mask
+            for round_key in self._round_keys:
+                mixed = ((right * 0x9E3779B1 + round_key) ^ (right >> 5)) * 0x85EBCA6B
+                left, right = right, left ^ (mixed >> 7 & self._half_mask)
+            value = left << self._half_bits | right
+            if value < self._size:
+                return value
@@ -0,0 +1,85 @@
+import gzip
+import json
+import os
+
+SEGMENT_SUFFIX = ".jsonl.gz"
+INDEX_SUFFIX = ".idx.json"
+
+
+class HistoryArchive:
+    # Old history entries moved out of the hot data file. Each compaction
+    # writes one segment: a gzip file of JSONL lines
+    #   [account_number, seq, kind, amount, fee, timestamp, txn_id, counterparty]
+    # where every account's lines are a separate gzip member, plus a small
+    # index {account_number: [offset, length, first_seq, count]} so one
+    # account's entries can be read without decompressing the whole segment.
+    # The whole segment is still an ordinary .jsonl.gz file.
+    def __init__(self, directory):
+        self.directory = directory
+        self._indexes = {}
+
+    def segments(self):
+        # Oldest first; a segment only counts once its index is written.
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len(INDEX_SUFFIX)] for name in names if name.endswith(INDEX_SUFFIX))
+
+    def write_segment(self, label, accounts):
+        # accounts is an iterable of (account_number, first_seq, entries).
+        # Returns the segment name, or None if there was nothing to write.
+        accounts = [account for account in accounts if account[2]]
+        if not accounts:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{len(self.segments()):06d}-{label}"
+        path = os.path.join(self.directory, name + SEGMENT_SUFFIX)
+        index = {}
+        with open(path, "wb") as file:
+            for acc_num, first_seq, entries in accounts:
+                lines = "".join(json.dumps([acc_num, first_seq + i, *entry]) + "\n" for i, entry in enumerate(entries))
+                offset = file.tell()
+                file.write(gzip.compress(lines.encode()))
+                index[str(acc_num)] = [offset, file.tell() - offset, first_seq, len(entries)]
+            file.flush()
+            os.fsync(file.fileno())
+        temp_file = os.path.join(self.directory, name + INDEX_SUFFIX + ".tmp")
+        with open(temp_file, "w") as file:
+            json.dump(index, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, os.path.join(self.directory, name + INDEX_SUFFIX))
+        self._indexes[name] = index
+        return name
+
+    def read(self, account_number, stop):
+        # One account's archived entries with seq < stop, oldest first, as
+        # (seq, entry list) pairs. A seq archived twice (a crash between
+        # writing a segment and the snapshot) is only returned once.
+        expected = 0
+        for name in self.segments():
+            location = self._index(name).get(str(account_number))
+            if location is None:
+                continue
+            offset, length, first_seq, count = location
+            if first_seq + count <= expected:
+                continue
+            with open(os.path.join(self.directory, name + SEGMENT_SUFFIX), "rb") as file:
+                file.seek(offset)
+                lines = gzip.decompress(file.read(length)).decode().splitlines()
+            for line in lines:
+                row = json.loads(line)
+                seq = row[1]
+                if seq >= stop:
+                    return
+                if seq >= expected:
+                    expected = seq + 1
+                    yield seq, row[2:]
+
+    def _index(self, name):
+        index = self._indexes.get(name)
+        if index is None:
+            with open(os.path.join(self.directory, name + INDEX_SUFFIX)) as file:
+                index = self._indexes[name] = json.load(file)
+        return index
@@ -0,0 +1,228 @@
+from bankcore import Account, Bank, BankError
+from banksecurity import hash_secret
+from bankstress import make_storage
+import argparse
+import bankingappmultiuser
+import contextlib
+import io
+import json
+import multiprocessing
+import random
+import resource
+import tempfile
+import time
+
+# Workload files are JSONL: first one "create" line per account, then the
+# operations to time. Accounts are referred to by username because account
+# numbers are only known once the accounts exist.
+#
+#   {"op": "create", "name", "username", "password", "pin", "balance"}
+#   {"op": "login", "username", "password"}
+#   {"op": "deposit" | "withdraw", "username", "amount"}
+#   {"op": "transfer", "username", "to", "amount", "pin"}
+#
+# Each mode is replayed in its own process so startup time and peak memory
+# are not skewed by the modes that ran before it.
+
+MODES = ("memory", "journal", "snapshot", "binary", "sqlite", "sharded")
+SHARD_COUNT = 16
+BATCH_SIZE = 10000  # accounts written per save while loading the workload
+# snapshot mode rewrites the whole bank on every operation, so it runs only
+# as many operations as rewrite this many accounts in all, and is left out
+# of a bank too large for MIN_OPERATIONS of them.
+SNAPSHOT_REWRITES = 2000000
+MIN_OPERATIONS = 100
+
+def generate(path, accounts, operations, seed=0):
+    rng = random.Random(seed)
+    with open(path, "w") as file:
+        for i in range(accounts):
+            file.write(json.dumps({"op": "create", "name": f"User {i}", "username": f"user{i}", "password": "secret",
+                                   "pin": "1234", "balance": rng.randint(100, 10000)}) + "\n")
+        for _ in range(operations):
+            username = f"user{rng.randrange(accounts)}"
+            choice = rng.random()
+            if choice < 0.1:
+                op = {"op": "login", "username": username, "password": "secret"}
+            elif choice < 0.45:
+                op = {"op": "deposit", "username": username, "amount": rng.randint(1, 500)}
+            elif choice < 0.7:
+                op = {"op": "withdraw", "username": username, "amount": rng.randint(1, 200)}
+            else:
+                op = {"op": "transfer", "username": username, "to": f"user{rng.randrange(accounts)}",
+                      "amount": rng.randint(1, 200), "pin": "1234"}
+            file.write(json.dumps(op) + "\n")
+
+def read_workload(path):
+    creates, operations = [], []
+    with open(path) as file:
+        for line in file:
+            op = json.loads(line)
+            (creates if op["op"] == "create" else operations).append(op)
+    return creates, operations
+
+
+class MemoryTarget:
+    # bankingappmultiuser.py: everything in memory, results printed.
+    def __init__(self, creates):
+        self.bank = bankingappmultiuser.Bank()
+        self.numbers = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for op in creates:
+                account = self.bank.create_account(op["name"], op["username"], op["password"], op["pin"], op["balance"])
+                self.numbers[op["username"]] = account.get_account_number()
+
+    def startup(self):
+        pass
+
+    def run(self, op):
+        with contextlib.redirect_stdout(io.StringIO()):
+            account = self.bank.get_account(self.numbers[op["username"]])
+            if op["op"] == "login":
+                self.bank.login(op["username"], op["password"])
+            elif op["op"] == "deposit":
+                account.deposit(op["amount"])
+            elif op["op"] == "withdraw":
+                account.withdraw(op["amount"])
+            elif op["op"] == "transfer":
+                account.transfer(self.bank.get_account(self.numbers[op["to"]]), op["amount"], op["pin"])
+
+    def close(self):
+        pass
+
+
+class PersistentTarget:
+    # bankcore.Bank on one of the storage backends.
+    def __init__(self, mode, creates, directory):
+        self.mode = mode
+        self.directory = directory
+        self.numbers = {}
+        bank = Bank(make_storage(mode, directory, SHARD_COUNT))
+        # Stored hashed, as the bank would, but hashed once per distinct
+        # secret: loading must not take a PBKDF2 run per account, and
+        # logins must not time the one-off rehash of a plaintext password.
+        hashes = {}
+        batch = []
+        for i, op in enumerate(creates):
+            for secret in (op["password"], op["pin"]):
+                if secret not in hashes:
+                    hashes[secret] = hash_secret(secret)
+            password, pin = hashes[op["password"]], hashes[op["pin"]]
+            account = Account(op["name"], op["username"], password, pin, op["balance"] * 100, account_number=100000 + i)
+            bank.accounts[account.get_account_number()] = account
+            bank.users[op["username"]] = (password, account.get_account_number())
+            self.numbers[op["username"]] = account.get_account_number()
+            batch.append(account)
+            if len(batch) == BATCH_SIZE:
+                bank.save(*batch)
+                batch = []
+        if batch:
+            bank.save(*batch)
+        bank.checkpoint()
+        bank.close()
+        self.bank = None
+
+    def startup(self):
+        self.bank = Bank(make_storage(self.mode, self.directory, SHARD_COUNT), lazy=True)  # as bankingwithjson opens every storage
+        # A lazy Bank reads nothing yet; counting the accounts does what the
+        # first login or listing would (a JSON file is parsed in full), so
+        # that is timed here rather than in the first operation.
+        self.bank.storage.count()
+
+    def run(self, op):
+        number = self.numbers[op["username"]]
+        try:
+            if op["op"] == "login":
+                self.bank.login(op["username"], op["password"])
+            elif op["op"] == "deposit":
+                self.bank.deposit(number, op["amount"])
+            elif op["op"] == "withdraw":
+                self.bank.withdraw(number, op["amount"])
+            elif op["op"] == "transfer":
+                self.bank.transfer(number, self.numbers[op["to"]], op["amount"], op["pin"])
+        except BankError:
+            pass
+
+    def close(self):
+        self.bank.close()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def measure(mode, workload, results):
+    creates, operations = read_workload(workload)
+    if mode == "snapshot":
+        operations = operations[:SNAPSHOT_REWRITES // max(len(creates), 1)]
+        if len(operations) < MIN_OPERATIONS:
+            results.put({"mode": mode, "accounts": len(creates), "skipped": True})
+            return
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        target = MemoryTarget(creates) if mode == "memory" else PersistentTarget(mode, creates, directory)
+        load_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        target.startup()
+        startup_time = time.perf_counter() - started
+
+        latencies = []
+        started = time.perf_counter()
+        for op in operations:
+            op_started = time.perf_counter()
+            target.run(op)
+            latencies.append(time.perf_counter() - op_started)
+        elapsed = time.perf_counter() - started
+        target.close()
+    latencies.sort()
+    results.put({
+        "mode": mode,
+        "accounts": len(creates),
+        "operations": len(operations),
+        "load_s": load_time,
+        "startup_s": startup_time,
+        "ops_per_s": len(operations) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+def run(workload, modes):
+    rows = []
+    for mode in modes:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure, args=(mode, workload, results))
+        process.start()
+        row = results.get()
+        process.join()
+        rows.append(row)
+        if row.get("skipped"):
+            print(f"{row['mode']:>8}  accounts {row['accounts']:>8}  skipped: a full rewrite per operation is too slow at this size")
+            continue
+        print(f"{row['mode']:>8}  accounts {row['accounts']:>8}  load {row['load_s']:8.2f}s  startup {row['startup_s'] * 1000:9.1f}ms  "
+              f"{row['ops_per_s']:10.0f} ops/s  p50 {row['p50_ms']:7.3f}ms  p99 {row['p99_ms']:7.3f}ms  peak {row['peak_rss_mb']:8.1f}MB")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate and replay banking workloads.")
+    parser.add_argument("--accounts", type=int, nargs="+", default=[1000, 100000, 1000000],
+                        help="bank sizes to generate synthetic workloads for")
+    parser.add_argument("--operations", type=int, default=10000)
+    parser.add_argument("--workload", help="replay this JSONL file instead of generating one")
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    all_rows = []
+    if args.workload:
+        all_rows += run(args.workload, args.modes)
+    else:
+        for accounts in args.accounts:
+            with tempfile.NamedTemporaryFile(suffix=".jsonl") as workload:
+                generate(workload.name, accounts, args.operations)
+                all_rows += run(workload.name, args.modes)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(all_rows, file, indent=4)
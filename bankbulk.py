@@ -0,0 +1,91 @@
+from bankcore import IMPORT_BATCH, Bank
+from bankmoney import format_money
+from banksecurity import PBKDF2_ITERATIONS
+from bankstorage import open_storage
+import argparse
+import csv
+import json
+
+# Bulk account import and export. Both stream: an import is read and
+# committed a batch at a time (see Bank.import_accounts) and an export
+# writes each account as storage hands it over, without its history.
+#
+# Import rows have name, username, password, pin, balance (dollars) and an
+# optional account_number and locked; an export with credentials can be
+# imported again, locked accounts staying locked.
+
+FORMATS = ("csv", "jsonl")
+EXPORT_COLUMNS = ["account_number", "name", "username", "balance", "locked"]
+CREDENTIAL_COLUMNS = ["password", "pin"]
+
+def file_format(path, fmt=None):
+    fmt = fmt or ("jsonl" if path.endswith(".jsonl") else "csv")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    return fmt
+
+def read_jsonl(file):
+    for line in file:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                yield None  # rejected as "Not an account record."
+
+def import_accounts(bank, path, fmt=None, batch_size=None, iterations=None):
+    # Returns (accounts created, [(row number, message)] for rejected rows).
+    fmt = file_format(path, fmt)
+    with open(path, newline="") as file:
+        rows = csv.DictReader(file) if fmt == "csv" else read_jsonl(file)
+        return bank.import_accounts(rows, batch_size or IMPORT_BATCH, iterations or PBKDF2_ITERATIONS)
+
+def account_rows(bank, credentials=False):
+    for acc_data in bank.storage.iter_accounts():
+        row = [acc_data["account_number"], acc_data["name"], acc_data["username"],
+               format_money(acc_data["balance_cents"]), acc_data["locked"]]
+        if credentials:
+            row += [acc_data["password"], acc_data["pin"]]
+        yield row
+
+def export_accounts(bank, path, fmt=None, credentials=False):
+    # Returns the number of accounts written.
+    fmt = file_format(path, fmt)
+    columns = EXPORT_COLUMNS + (CREDENTIAL_COLUMNS if credentials else [])
+    count = 0
+    with open(path, "w", newline="") as file:
+        if fmt == "csv":
+            writer = csv.writer(file)
+            writer.writerow(columns)
+            for row in account_rows(bank, credentials):
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in account_rows(bank, credentials):
+                file.write(json.dumps(dict(zip(columns, row))) + "\n")
+                count += 1
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import or export accounts in bulk as CSV or JSONL.")
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--db", help="use this JSON file, .bin snapshot, SQLite database or shard directory instead of bank_data.json")
+    parser.add_argument("--batch", type=int, help="accounts committed per storage write on import")
+    parser.add_argument("--iterations", type=int,
+                        help=f"PBKDF2 iterations for imported plaintext passwords and PINs (default: {PBKDF2_ITERATIONS}); "
+                             "fewer make a large import faster, and each is rehashed in full on the account's first use")
+    parser.add_argument("--credentials", action="store_true", help="include passwords and PINs in an export")
+    args = parser.parse_args()
+    bank = Bank(open_storage(args.db), lazy=True)
+    try:
+        if args.action == "import":
+            created, rejected = import_accounts(bank, args.path, args.format, args.batch, args.iterations)
+            for row_number, message in rejected:
+                print(f"Row {row_number}: {message}")
+            print(f"Imported {created} accounts, rejected {len(rejected)}.")
+        else:
+            count = export_accounts(bank, args.path, args.format, args.credentials)
+            print(f"Exported {count} accounts to {args.path}")
+    finally:
+        bank.close()
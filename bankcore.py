@@ -0,0 +1,798 @@
+from bankallocator import AccountNumberAllocator
+from bankmetrics import count, timed
+from bankmoney import TRANSFER_FEE_PER_MILLE, WITHDRAWAL_FEE_PER_MILLE, fee_cents, to_cents
+from banksecurity import PBKDF2_ITERATIONS, SessionCache, hash_secret, hash_secrets, is_hashed, needs_rehash, verify_secret
+from bankstorage import ACCOUNT_SORTS, ConflictError, JsonStorage, make_entry
+from contextlib import contextmanager
+from collections import namedtuple
+import time
+
+# The banking engine: no print() or input() here. Every operation returns a
+# result or raises a BankError whose message is ready to show a user.
+# Amounts passed in are dollars; balances, fees, receipts and history
+# entries are whole cents (see bankmoney).
+
+Receipt = namedtuple("Receipt", "kind account_number amount fee balance counterparty txn_id", defaults=(None,))
+BatchResult = namedtuple("BatchResult", "sender recipient amount fee ok message")
+
+IMPORT_BATCH = 10000  # accounts per storage write in Bank.import_accounts
+# The optional locked column of an import, as CSV text or a JSON boolean.
+LOCKED_VALUES = {"": False, "false": False, "0": False, "no": False, "true": True, "1": True, "yes": True}
+
+
+class BankError(Exception):
+    pass
+
+class InvalidAmountError(BankError):
+    pass
+
+class InsufficientFundsError(BankError):
+    pass
+
+class IncorrectPinError(BankError):
+    pass
+
+class AccountLockedError(BankError):
+    pass
+
+class AccountNotFoundError(BankError):
+    pass
+
+class UsernameTakenError(BankError):
+    pass
+
+class InvalidCredentialsError(BankError):
+    pass
+
+class SameAccountError(BankError):
+    pass
+
+class AccountNumberTakenError(BankError):
+    pass
+
+class SessionError(BankError):
+    pass
+
+class ChangedElsewhereError(BankError):
+    # storage's ConflictError: another process changed the account or took
+    # the username first. Nothing was written; the operation can be retried.
+    pass
+
+
+def amount_cents(amount):
+    # to_cents for amounts from callers: text that is not a number, nan and
+    # inf are an InvalidAmountError like any other bad amount.
+    try:
+        return to_cents(amount)
+    except (ArithmeticError, ValueError):
+        raise InvalidAmountError(f"Invalid amount: {amount}")
+
+
+class Account:
+    # __slots__ keeps a million-account bank from paying for a __dict__ per account.
+    __slots__ = ("name", "username", "password", "pin", "__account_number", "__balance", "locked",
+                 "login_attempts", "pin_attempts", "version", "_history_loader", "_history",
+                 "_new_entries", "_synced")
+
+    def __init__(self, name, username, password, pin, balance_cents, account_number, transaction_history=None,  locked=False, login_attempts=0, pin_attempts=0, history_loader=None, history_count=0, version=0, txn_id=None):
+        self.name = name
+        self.username = username
+        self.password = password
+        self.pin = pin
+        # Always given: numbers come from the Bank's allocator or from storage.
+        self.__account_number = account_number
+        self.__balance = balance_cents
+        self.locked = locked
+        self.login_attempts = login_attempts
+        self.pin_attempts = pin_attempts
+        self.version = version  # bumped on every write, see Bank.save
+        # With a history_loader the stored history is only read when it is
+        # first needed; entries logged before then wait in _new_entries.
+        self._history_loader = history_loader
+        self._history = None if history_loader else (transaction_history if transaction_history else [])
+        self._new_entries = [] if history_loader else None
+        self._synced = history_count if history_loader else len(self._history)  # entries already on disk
+        if not transaction_history and not history_loader:
+            self._log_transaction("Account created", balance_cents, 0, txn_id)
+
+    def refresh(self, acc_data, history_loader):
+        # Replaces this object's state with what another process saved.
+        self.name = acc_data["name"]
+        self.username = acc_data["username"]
+        self.password = acc_data["password"]
+        self.pin = acc_data["pin"]
+        self.__balance = acc_data["balance_cents"]
+        self.locked = acc_data.get("locked", False)
+        self.login_attempts = acc_data.get("login_attempts", 0)
+        self.pin_attempts = acc_data.get("pin_attempts", 0)
+        self.version = acc_data.get("version", 0)
+        self._history_loader = history_loader
+        self._history = None
+        self._new_entries = []
+        self._synced = acc_data["history_count"]
+
+    @property
+    def transaction_history(self):
+        # The hot history only: entries archived by the storage are not
+        # loaded with the account. Bank.history and Bank.statement read both.
+        if self._history is None:
+            self._history = self._history_loader()
+            self._history.extend(self._new_entries)
+            self._new_entries = None
+        return self._history
+
+    def is_locked(self):
+        return self.locked
+    
+    def reset_attempts(self):
+        self.login_attempts = 0
+        self.pin_attempts = 0
+    
+    def deposit(self, amount, txn_id=None):
+        cents = amount_cents(amount)
+        if cents <= 0:
+            raise InvalidAmountError("Deposit amount must be positive.")
+        self.__balance += cents
+        self._log_transaction("Deposit", cents, 0, txn_id)
+        return Receipt("deposit", self.__account_number, cents, 0, self.__balance, None, txn_id)
+
+    def withdraw(self, amount, txn_id=None):
+        cents = amount_cents(amount)
+        if cents > 0 and cents <= self.__balance:
+            fee = fee_cents(cents, WITHDRAWAL_FEE_PER_MILLE)
+            total_amount = cents + fee
+            if total_amount > self.__balance:
+                raise InsufficientFundsError("Insufficient funds including fee.")
+            self.__balance -= total_amount
+            self._log_transaction("Withdrawal", cents, fee, txn_id)
+            return Receipt("withdrawal", self.__account_number, cents, fee, self.__balance, None, txn_id)
+        elif cents > self.__balance:
+            raise InsufficientFundsError("Insufficient funds.")
+        else:
+            raise InvalidAmountError("Withdrawal amount must be positive.")
+
+    def transfer(self, recipient, amount, pin, txn_id=None):
+        self._check_pin(pin)
+        return self._move_funds(recipient, amount_cents(amount), txn_id)
+
+    def _check_pin(self, pin):
+        if not verify_secret(self.pin, pin):
+            self.pin_attempts += 1
+            if self.pin_attempts >= 3:
+                self.locked = True
+                raise AccountLockedError("Too many wrong PIN entries. Account has been locked.")
+            raise IncorrectPinError(f"Incorrect PIN,Transfer denied. {3 - self.pin_attempts} attempts left.")
+        self.pin_attempts = 0
+        if needs_rehash(self.pin):
+            self.pin = hash_secret(pin)  # plaintext or a bulk load's cheaper hash, saved with the transfer
+
+    def _move_funds(self, recipient, cents, txn_id=None):
+        if recipient == self:
+            raise SameAccountError("You cannot transfer funds to your own account.")
+        receipt = self._send_funds(recipient.__account_number, recipient.name, cents, txn_id)
+        recipient._receive_funds(self.__account_number, self.name, cents, txn_id)
+        return receipt
+
+    # A transfer is two halves so that the recipient can live in another
+    # Bank (see bankpool). Double entry under one txn_id: the sender's debit
+    # and the recipient's credit name each other; the fee leg goes to the bank.
+    def _send_funds(self, recipient_number, recipient_name, cents, txn_id=None):
+        if cents <= 0 or cents > self.__balance:
+            raise InsufficientFundsError("Insufficient funds or invalid amount.")
+        fee = fee_cents(cents, TRANSFER_FEE_PER_MILLE)
+        total_amount = cents + fee
+        if total_amount > self.__balance:
+            raise InsufficientFundsError("Insufficient funds including fee.")
+        self.__balance -= total_amount
+        self._log_transaction(f"Transfer to {recipient_name}", cents, fee, txn_id, recipient_number)
+        self._log_transaction("Transfer Fee", fee, fee, txn_id)
+        return Receipt("transfer", self.__account_number, cents, fee, self.__balance, recipient_number, txn_id)
+
+    def _receive_funds(self, sender_number, sender_name, cents, txn_id=None):
+        self.__balance += cents
+        self._log_transaction(f"Received from {sender_name}", cents, 0, txn_id, sender_number)
+
+    def _savepoint(self):
+        entries = self._new_entries if self._history is None else self._history
+        return self.__balance, entries, len(entries)
+
+    def _rollback(self, savepoint):
+        self.__balance, entries, length = savepoint
+        del entries[length:]
+
+    def _log_transaction(self, transaction_type, amount, fee=0, txn_id=None, counterparty=None):
+        entries = self._new_entries if self._history is None else self._history
+        entries.append(make_entry(transaction_type, amount, fee, int(time.time()), txn_id, counterparty))
+    
+    def get_account_number(self):
+        return self.__account_number
+
+    def get_balance(self):
+        return self.__balance
+    
+    def to_dict(self):
+        data = self._fields()
+        data["transaction_history"] = self.transaction_history
+        return data
+
+    def _fields(self):
+        return {
+            "name": self.name,
+            "username": self.username,
+            "password": self.password,
+            "pin": self.pin,
+            "account_number": self.__account_number,
+            "balance_cents": self.__balance,
+            "locked": self.locked,
+            "login_attempts": self.login_attempts,
+            "pin_attempts": self.pin_attempts,
+            "version": self.version
+        }
+
+    def journal_record(self):
+        record = self._fields()
+        record["version"] = self.version + 1
+        record["history_start"] = self._synced
+        if self._history is None:
+            record["transaction_history"] = self._new_entries
+            self._new_entries = []
+        else:
+            record["transaction_history"] = self._history[self._synced:]
+        self._synced += len(record["transaction_history"])
+        return record
+
+
+def account_from_data(acc_num, acc_data, history_loader=None):
+    return Account(
+        name=acc_data["name"],
+        username=acc_data["username"],
+        password=acc_data["password"],
+        pin=acc_data["pin"],
+        balance_cents=acc_data["balance_cents"],
+        account_number=int(acc_num),
+        transaction_history=acc_data.get("transaction_history", []),
+        locked=acc_data.get("locked", False),
+        login_attempts=acc_data.get("login_attempts", 0),
+        pin_attempts=acc_data.get("pin_attempts", 0),
+        history_loader=history_loader,
+        history_count=acc_data.get("history_count", 0),
+        version=acc_data.get("version", 0)
+    )
+
+
+class LazyAccounts:
+    # Dict-like view over storage: an Account is built on its first lookup
+    # and its history is left on disk until something reads it.
+    def __init__(self, storage, cache=None):
+        self.storage = storage
+        self._cache = cache if cache is not None else {}
+
+    def get(self, account_number, default=None):
+        account = self._cache.get(account_number)
+        count("cache.accounts.hits" if account is not None else "cache.accounts.misses")
+        if account is None:
+            acc_data = self.storage.get_account(account_number)
+            if acc_data is None:
+                return default
+            account = account_from_data(account_number, acc_data,
+                                        lambda: self.storage.get_history(account_number))
+            self._cache[account_number] = account
+        return account
+
+    def __getitem__(self, account_number):
+        account = self.get(account_number)
+        if account is None:
+            raise KeyError(account_number)
+        return account
+
+    def __setitem__(self, account_number, account):
+        self._cache[account_number] = account
+
+    def __contains__(self, account_number):
+        return self.get(account_number) is not None
+
+    def __len__(self):
+        return self.storage.count()
+
+    def __iter__(self):
+        return iter(self.storage.account_numbers())
+
+    def loaded(self):
+        return self._cache.values()
+
+    def values(self):
+        return (self[acc_num] for acc_num in self)
+
+    def items(self):
+        return ((acc_num, self[acc_num]) for acc_num in self)
+
+
+class LazyUsers:
+    def __init__(self, storage):
+        self.storage = storage
+        self._cache = {}
+
+    def get(self, username, default=None):
+        user = self._cache.get(username)
+        count("cache.users.hits" if user is not None else "cache.users.misses")
+        if user is None:
+            user = self.storage.find_user(username)
+            if user is None:
+                return default
+            user = self._cache[username] = tuple(user)
+        return user
+
+    def __getitem__(self, username):
+        user = self.get(username)
+        if user is None:
+            raise KeyError(username)
+        return user
+
+    def __setitem__(self, username, user):
+        self._cache[username] = user
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+class Bank:
+    def __init__(self, storage=None, lazy=False):
+        self.storage = storage if storage is not None else JsonStorage()
+        self.admin_credentials = {"admin": "admin123"}
+        self.allocator = AccountNumberAllocator(self.storage.allocator_path)
+        self.sessions = SessionCache()
+        if lazy:
+            self.accounts = LazyAccounts(self.storage)
+            self.users = LazyUsers(self.storage)
+            return
+        # Eager: every account is built now. Accounts and users that other
+        # processes add later are still found in storage on a miss.
+        data = self.storage.load()
+        self.accounts = LazyAccounts(self.storage, {
+            int(acc_num): account_from_data(acc_num, acc_data)
+            for acc_num, acc_data in data["accounts"].items()
+        })
+        self.users = LazyUsers(self.storage)
+
+    @timed("bank.create_account")
+    def create_account(self, name, username, password, pin, initial_balance, account_number=None, hashed=False):
+        # hashed: password and pin are already hash_secret values, made by
+        # the caller (off the engine's thread, or once for many accounts).
+        balance = amount_cents(initial_balance)
+        if balance < 0:
+            raise InvalidAmountError("Initial balance cannot be negative.")
+        if self.find_user(username) is not None:
+            raise UsernameTakenError("Username already exists. Choose a different username.")
+        if account_number is None:
+            account_number = self._allocate_number()
+        elif self.get_account(account_number) is not None:
+            raise AccountNumberTakenError(f"Account number {account_number} is already in use.")
+        if not hashed:
+            password, pin = hash_secrets([password, pin])
+        new_account = Account(name, username, password, pin, balance,
+                              account_number, txn_id=self.storage.next_txn_id())
+        self.save(new_account)  # kept only once it is written
+        self.accounts[new_account.get_account_number()] = new_account
+        self.users[username] = (new_account.password, new_account.get_account_number())
+        return new_account
+
+    @timed("bank.import_accounts")
+    def import_accounts(self, rows, batch_size=IMPORT_BATCH, iterations=PBKDF2_ITERATIONS):
+        # Bulk account creation. rows are dicts with name, username, password,
+        # pin, balance (dollars) and optionally account_number and locked; every batch
+        # is one storage write with one block of txn ids, instead of a write
+        # and an id per account. Plaintext passwords and PINs of a batch are
+        # hashed together on every CPU, with iterations rounds (see
+        # banksecurity: fewer are rehashed on first use). Returns the number
+        # of accounts created and (row number, message) for each row left out.
+        created = 0
+        rejected = []
+        batch = []
+        pending = set()  # usernames and account numbers claimed by the batch
+        with self.storage.bulk():
+            for row_number, row in enumerate(rows, 1):
+                try:
+                    batch.append(self._import_row(row, pending))
+                except BankError as error:
+                    rejected.append((row_number, str(error)))
+                    continue
+                if len(batch) >= batch_size:
+                    created += self._commit_import(batch, iterations)
+                    batch = []
+                    pending = set()
+            if batch:
+                created += self._commit_import(batch, iterations)
+            if created:
+                # Folded in once, at the end of the load, rather than replayed
+                # by every process that opens the bank afterwards.
+                self.checkpoint()
+        return created, rejected
+
+    def _import_row(self, row, pending):
+        if not isinstance(row, dict):
+            raise BankError("Not an account record.")
+        fields = []
+        for field in ("name", "username", "password", "pin", "balance"):
+            value = str(row.get(field) or "").strip()
+            if not value:
+                raise BankError(f"Missing {field}.")
+            fields.append(value)
+        name, username, password, pin, balance = fields
+        if username in pending or username in self.users:
+            raise UsernameTakenError(f"Username {username} already exists.")
+        cents = amount_cents(balance)
+        if cents < 0:
+            raise InvalidAmountError("Initial balance cannot be negative.")
+        account_number = row.get("account_number")
+        if account_number:
+            try:
+                account_number = int(account_number)
+            except ValueError:
+                raise BankError(f"Invalid account number: {account_number}")
+            if account_number in pending or account_number in self.accounts:
+                raise AccountNumberTakenError(f"Account number {account_number} is already in use.")
+        else:
+            account_number = self._allocate_number(pending)
+        locked = str(row.get("locked") or "").strip().lower()
+        if locked not in LOCKED_VALUES:
+            raise BankError(f"Invalid locked value: {row['locked']}")
+        pending.update((username, account_number))
+        return name, username, password, pin, cents, account_number, LOCKED_VALUES[locked]
+
+    def _commit_import(self, batch, iterations):
+        # Hashed values (from an export with credentials) are kept as they are.
+        hashes = iter(hash_secrets([secret for row in batch for secret in row[2:4] if not is_hashed(secret)],
+                                   iterations))
+        batch = [row[:2] + tuple(secret if is_hashed(secret) else next(hashes) for secret in row[2:4]) + row[4:]
+                 for row in batch]
+        first_id = self.storage.next_txn_id(len(batch))
+        accounts = [Account(name, username, password, pin, cents, account_number, locked=locked, txn_id=txn_id)
+                    for txn_id, (name, username, password, pin, cents, account_number, locked)
+                    in enumerate(batch, first_id)]
+        self.write([account.journal_record() for account in accounts])
+        # Not kept: the bank finds imported accounts in storage when needed.
+        return len(accounts)
+
+    def _allocate_number(self, pending=()):
+        # Allocated numbers never repeat; the loop only skips numbers given
+        # out before the allocator existed or claimed explicitly.
+        account_number = self.allocator.allocate()
+        while account_number in pending or account_number in self.accounts:
+            account_number = self.allocator.allocate()
+        return account_number
+
+    @timed("bank.login")
+    def login(self, username, password, checked=None):
+        # The password is checked (a full PBKDF2 run) before the account is
+        # locked, so other requests for it do not wait on the hash; it is
+        # checked again inside only if the stored password changed meanwhile.
+        # checked is (stored password, verify_secret result) when the caller
+        # already ran the check itself.
+        user = self.find_user(username)
+        if user is None:
+            raise InvalidCredentialsError("Username not found.")
+        account_number = user[1]
+        stored, ok = checked or (user[0], verify_secret(user[0], password))
+        with self.transaction(account_number):
+            account = self.accounts.get(account_number)
+            if account.is_locked():
+                raise AccountLockedError("Account is locked. Contact admin to unlock.")
+            if account.password != stored:
+                ok = verify_secret(account.password, password)
+            if ok:
+                # Only written when something changed: a login that follows
+                # failed attempts, or the first one since the password was
+                # stored in plaintext or with a bulk load's cheaper hash.
+                if account.login_attempts or account.pin_attempts or needs_rehash(account.password):
+                    account.reset_attempts()
+                    if needs_rehash(account.password):
+                        account.password = hash_secret(password)
+                    self.users[username] = (account.password, account_number)
+                    self.save(account)
+                return account
+            account.login_attempts += 1
+            if account.login_attempts >= 3:
+                account.locked = True
+                error = AccountLockedError("Too many failed login attempts. Account has been locked.")
+            else:
+                error = InvalidCredentialsError(f"Invalid password. {3 - account.login_attempts} attempts left.")
+            self.save(account)
+        # Raised outside the transaction so the new attempt count is committed.
+        raise error
+
+    def open_session(self, username, password, checked=None):
+        # Logs in and returns (session token, account); see banksecurity.
+        account = self.login(username, password, checked)
+        return self.sessions.open(account.get_account_number()), account
+
+    def session_account(self, token):
+        account_number = self.sessions.get(token)
+        if account_number is None:
+            raise SessionError("Not logged in or session expired.")
+        return account_number
+
+    def close_session(self, token):
+        self.sessions.close(token)
+
+    def check_admin(self, username, password):
+        if self.admin_credentials.get(username) != password:
+            raise InvalidCredentialsError("Invalid admin credentials.")
+
+    def get_account(self, account_number):
+        # A miss looks again after re-reading storage: the account may have
+        # been opened by another process since.
+        account = self.accounts.get(account_number, None)
+        if account is None:
+            self.storage.refresh()
+            account = self.accounts.get(account_number, None)
+        return account
+
+    def find_user(self, username):
+        # (password, account number), or None; a miss re-reads storage like get_account.
+        user = self.users.get(username)
+        if user is None:
+            self.storage.refresh()
+            user = self.users.get(username)
+        return user
+
+    def require_account(self, account_number):
+        account = self.get_account(account_number)
+        if account is None:
+            raise AccountNotFoundError(f"Account {account_number} not found.")
+        return account
+
+    @timed("bank.deposit")
+    def deposit(self, account_number, amount):
+        with self.transaction(account_number):
+            account = self.require_account(account_number)
+            receipt = account.deposit(amount, self.storage.next_txn_id())
+            self.save(account)
+        return receipt
+
+    @timed("bank.withdraw")
+    def withdraw(self, account_number, amount):
+        with self.transaction(account_number):
+            account = self.require_account(account_number)
+            receipt = account.withdraw(amount, self.storage.next_txn_id())
+            self.save(account)
+        return receipt
+
+    @timed("bank.transfer")
+    def transfer(self, sender_number, recipient_number, amount, pin):
+        with self.transaction(sender_number, recipient_number):
+            sender = self.require_account(sender_number)
+            recipient = self.require_account(recipient_number)
+            error = self._authorize(sender, pin)
+            if error is None:
+                receipt = sender._move_funds(recipient, amount_cents(amount), self.storage.next_txn_id())
+                self.save(sender, recipient)
+                return receipt
+        raise error
+
+    def send_transfer(self, sender_number, recipient_number, recipient_name, amount, pin, txn_id):
+        # First half of a transfer to an account this Bank does not hold:
+        # the usual checks, then the debit and fee legs. The caller must hand
+        # the money on with receive_transfer on the recipient's Bank.
+        if sender_number == recipient_number:
+            raise SameAccountError("You cannot transfer funds to your own account.")
+        with self.transaction(sender_number):
+            sender = self.require_account(sender_number)
+            error = self._authorize(sender, pin)
+            if error is None:
+                receipt = sender._send_funds(recipient_number, recipient_name, amount_cents(amount), txn_id)
+                self.save(sender)
+                return receipt
+        raise error
+
+    def receive_transfer(self, recipient_number, sender_number, sender_name, cents, txn_id):
+        # Second half; a txn_id already credited to the account is not
+        # credited again, so a handoff can safely be retried.
+        with self.transaction(recipient_number):
+            recipient = self.require_account(recipient_number)
+            if not any(acc_num == recipient_number for acc_num, seq, entry in self.storage.find_transaction(txn_id)):
+                recipient._receive_funds(sender_number, sender_name, cents, txn_id)
+                self.save(recipient)
+        return recipient.get_balance()
+
+    def _authorize(self, sender, pin):
+        # PIN check before a transfer. A wrong PIN still saves the new attempt
+        # count (and lock) and is returned for the caller to raise once the
+        # transaction is over.
+        if sender.is_locked():
+            raise AccountLockedError("Account is locked. Contact admin to unlock.")
+        try:
+            sender._check_pin(pin)
+        except BankError as error:
+            self.save(sender)
+            return error
+        return None
+
+    def balance(self, account_number):
+        # In cents, as storage has it now: a cached Account (an eager Bank
+        # holds every one) can predate another process's last change.
+        self.storage.refresh()
+        account = self._reload(account_number)
+        if account is None:
+            raise AccountNotFoundError(f"Account {account_number} not found.")
+        return account.get_balance()
+
+    def history(self, account_number):
+        # Every entry, oldest first, archived ones included.
+        return [entry for seq, entry in self.statement(account_number)]
+
+    @timed("bank.history_page")
+    def history_page(self, account_number, limit=20, before=None, **filters):
+        # One page of (seq, entry) pairs, newest first, and the cursor to pass
+        # back as before= for the next older page (None on the last page).
+        # Only as much history is read as the page needs.
+        rows = []
+        for row in self.statement(account_number, before=before, newest_first=True, **filters):
+            if len(rows) == limit:
+                return rows, rows[-1][0]
+            rows.append(row)
+        return rows, None
+
+    def statement(self, account_number, since=None, until=None, kinds=None, min_amount=None, max_amount=None,
+                  before=None, newest_first=False, counterparty=None):
+        # Generator of (seq, entry) pairs, oldest first unless newest_first.
+        # since/until are Unix timestamps (until is exclusive), kinds is a list
+        # of prefixes such as "Deposit" or "Transfer", amounts are dollars and
+        # counterparty keeps only transfer legs with that account.
+        self.require_account(account_number)
+        low = None if min_amount is None else amount_cents(min_amount)
+        high = None if max_amount is None else amount_cents(max_amount)
+        for seq, entry in self.storage.iter_history(account_number, since, until, before, newest_first, counterparty):
+            if kinds and not entry.kind.startswith(tuple(kinds)):
+                continue
+            if (low is not None and entry.amount < low) or (high is not None and entry.amount > high):
+                continue
+            yield seq, entry
+
+    def find_transaction(self, txn_id):
+        # Every leg of one transaction as (account number, seq, entry).
+        return self.storage.find_transaction(txn_id)
+
+    @timed("bank.unlock")
+    def unlock(self, account_number):
+        with self.transaction(account_number):
+            account = self.require_account(account_number)
+            if not account.is_locked():
+                raise BankError("Account is not locked.")
+            account.locked = False
+            account.reset_attempts()
+            self.save(account)
+        return account
+
+    @timed("bank.overview")
+    def overview(self):
+        # Admin totals (see bankstorage.STAT_NAMES), kept up to date by every
+        # write, so this never walks the accounts.
+        self.storage.refresh()
+        return self.storage.stats()
+
+    @timed("bank.account_page")
+    def account_page(self, limit=20, after=None, sort="account_number", descending=False, locked=None,
+                     min_balance=None, max_balance=None):
+        # One page of accounts (dicts without history) sorted by an
+        # ACCOUNT_SORTS key, and the cursor to pass back as after= for the
+        # next page (None on the last page). Balances are dollars, inclusive.
+        if sort not in ACCOUNT_SORTS:
+            raise BankError(f"Cannot sort accounts by {sort}.")
+        low = None if min_balance is None else amount_cents(min_balance)
+        high = None if max_balance is None else amount_cents(max_balance)
+        self.storage.refresh()
+        rows = []
+        for acc_data in self.storage.iter_accounts(sort, descending, after, locked, low, high):
+            if len(rows) == limit:
+                last = rows[-1]
+                return rows, [last[ACCOUNT_SORTS[sort]], last["account_number"]]
+            rows.append(acc_data)
+        return rows, None
+
+    @contextmanager
+    def transaction(self, *account_numbers):
+        # Locks the accounts against other processes and reloads them from
+        # storage first, so a change is never applied to a stale balance.
+        with self.storage.lock(account_numbers):
+            for account_number in account_numbers:
+                self._reload(account_number)
+            yield
+
+    def _reload(self, account_number):
+        # The cached Account, brought up to date with storage (None when
+        # storage has no such account).
+        acc_data = self.storage.get_account(account_number)
+        if acc_data is None:
+            return None
+        loader = lambda: self.storage.get_history(account_number)
+        account = self.accounts._cache.get(account_number)
+        if account is None:
+            account = self.accounts[account_number] = account_from_data(account_number, acc_data, loader)
+        else:
+            account.refresh(acc_data, loader)
+        self.users[acc_data["username"]] = (acc_data["password"], account_number)
+        return account
+
+    @timed("bank.transfer_batch")
+    def transfer_batch(self, transfers, pins, atomic=False):
+        # transfers is an iterable of (from, to, amount) and pins maps each
+        # sending account number to its PIN. Every transfer is applied in
+        # memory under the usual PIN/fee/lock rules and the batch is saved
+        # once. With atomic=True one failure rolls back every balance change
+        # (wrong PIN attempts still count).
+        transfers = list(transfers)
+        account_numbers = {n for sender, recipient, amount in transfers for n in (sender, recipient)}
+        results = []
+        with self.transaction(*account_numbers):
+            savepoints = {}
+            pin_checks = {}
+            for sender_number, recipient_number, amount in transfers:
+                sender = self.get_account(sender_number)
+                recipient = self.get_account(recipient_number)
+                if sender is None or recipient is None:
+                    results.append(BatchResult(sender_number, recipient_number, amount, 0, False, "Account not found."))
+                    continue
+                if sender.is_locked():
+                    results.append(BatchResult(sender_number, recipient_number, amount, 0, False, "Account is locked."))
+                    continue
+                if sender_number not in pin_checks:
+                    try:
+                        sender._check_pin(pins.get(sender_number))
+                        pin_checks[sender_number] = None
+                    except BankError as error:
+                        pin_checks[sender_number] = str(error)
+                if pin_checks[sender_number] is not None:
+                    results.append(BatchResult(sender_number, recipient_number, amount, 0, False, pin_checks[sender_number]))
+                    continue
+                for account in (sender, recipient):
+                    savepoints.setdefault(account.get_account_number(), (account, account._savepoint()))
+                try:
+                    receipt = sender._move_funds(recipient, amount_cents(amount), self.storage.next_txn_id())
+                    results.append(BatchResult(sender_number, recipient_number, amount, receipt.fee, True, None))
+                except BankError as error:
+                    results.append(BatchResult(sender_number, recipient_number, amount, 0, False, str(error)))
+
+            if atomic and not all(result.ok for result in results):
+                for account, savepoint in savepoints.values():
+                    account._rollback(savepoint)
+                results = [result._replace(fee=0, ok=False, message="Batch rolled back.") if result.ok else result
+                           for result in results]
+            touched = [self.get_account(n) for n in account_numbers]
+            self.save(*[account for account in touched if account is not None])
+        return results
+
+    @timed("bank.save")
+    def save(self, *accounts):
+        # Only the given accounts are written, each as one small record.
+        # With no accounts every loaded account is written and the result
+        # folded into a full snapshot.
+        records = [acc.journal_record() for acc in (accounts or self._loaded_accounts())]
+        count("bank.saves")
+        count("bank.records_saved", len(records))
+        self.write(records)
+        for acc in (accounts or self._loaded_accounts()):
+            acc.version += 1
+        if not accounts:
+            self.checkpoint()
+
+    def write(self, records):
+        try:
+            self.storage.write(records)
+        except ConflictError as error:
+            raise ChangedElsewhereError(str(error)) from error
+
+    def checkpoint(self):
+        self.storage.checkpoint()
+
+    def subscribe(self, callback):
+        # callback(events) is called with the change-feed events (see
+        # bankfeed) of every commit this process makes, in order, once the
+        # storage locks are released; an exception in it is reported and
+        # does not undo the commit. Other
+        # processes' changes are read from the feed file with a FeedConsumer.
+        self.storage.feed.subscribe(callback)
+
+    def _loaded_accounts(self):
+        return list(self.accounts.loaded())
+
+    def close(self):
+        self.storage.close()
@@ -0,0 +1,106 @@
+from bankcore import Bank
+from bankmoney import format_money
+from bankpool import BankPool
+from banksecurity import hash_secret
+from bankshard import ShardedStorage
+from bankstorage import JsonStorage
+from bankstress import total_money
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+
+# Crash recovery of the two ways money crosses shards. A writer process is
+# killed (SIGKILL, so nothing is flushed or cleaned up on the way out) at a
+# chosen point of a transfer between two shards; then the bank is opened
+# again and every cent must still be either in a balance or in a fee, and
+# the transfer must have happened exactly when it got past its commit point.
+#
+#   shards-commit-log   bankshard: after commits.jsonl, before either shard journal
+#   shards-one-journal  bankshard: after the first shard's journal, before the second
+#   pool-handoff-log    bankpool: after handoffs.jsonl, before the debit
+#   pool-debit          bankpool: after the debit, before the credit
+ACCOUNTS = 8
+SHARD_COUNT = 4
+INITIAL_BALANCE = 1000
+AMOUNT = 10
+
+
+def crash_after(owner, name, when=None):
+    # Replaces owner.name so that this process is killed as soon as a call
+    # to it returns (one for which when(*args) is true, if given).
+    original = getattr(owner, name)
+
+    def wrapper(*args, **kwargs):
+        result = original(*args, **kwargs)
+        if when is None or when(*args, **kwargs):
+            os.kill(os.getpid(), signal.SIGKILL)
+        return result
+    setattr(owner, name, wrapper)
+
+def sends_debit(pool, batches, results):
+    return any(op[0] == "debit" for batch in batches for key, op in batch)
+
+# name -> (crash point, whether the transfer is committed once it is reached)
+SCENARIOS = {
+    "shards-commit-log": ((ShardedStorage, "_append_commit", None), True),
+    "shards-one-journal": ((JsonStorage, "_commit", None), True),
+    "pool-handoff-log": ((BankPool, "_log_handoffs", None), False),
+    "pool-debit": ((BankPool, "_dispatch", sends_debit), True),
+}
+
+def create_accounts(name, directory):
+    password, pin = hash_secret("secret"), hash_secret("1234")  # once, not per account
+    if name.startswith("pool"):
+        pool = BankPool(directory, SHARD_COUNT)
+        numbers = pool.run([("create", f"User {i}", f"user{i}", password, pin, INITIAL_BALANCE) for i in range(ACCOUNTS)])
+        pool.close()
+        return numbers
+    bank = Bank(ShardedStorage(directory, SHARD_COUNT), lazy=True)
+    numbers = [bank.create_account(f"User {i}", f"user{i}", password, pin, INITIAL_BALANCE, hashed=True).get_account_number()
+               for i in range(ACCOUNTS)]
+    bank.close()
+    return numbers
+
+def writer(name, directory, sender, recipient):
+    crash_after(*SCENARIOS[name][0])
+    if name.startswith("pool"):
+        BankPool(directory).run([("transfer", sender, recipient, AMOUNT, "1234")])
+    else:
+        Bank(ShardedStorage(directory), lazy=True).transfer(sender, recipient, AMOUNT, "1234")
+
+def reopen(name, directory):
+    # What the next process to use the bank does first: a new pool finishes
+    # the handoffs left open, and taking every shard's write lock (load()
+    # does) redoes the cross-shard commits left half done.
+    if name.startswith("pool"):
+        BankPool(directory).close()
+    storage = ShardedStorage(directory)
+    storage.load()
+    return Bank(storage, lazy=True)
+
+def run(name):
+    with tempfile.TemporaryDirectory() as directory:
+        numbers = create_accounts(name, directory)
+        sender = numbers[0]
+        recipient = next(number for number in numbers if number % SHARD_COUNT != sender % SHARD_COUNT)
+        process = multiprocessing.Process(target=writer, args=(name, directory, sender, recipient))
+        process.start()
+        process.join()
+
+        bank = reopen(name, directory)
+        expected = ACCOUNTS * INITIAL_BALANCE * 100
+        found = total_money(bank)
+        received = bank.balance(recipient) - INITIAL_BALANCE * 100
+        bank.close()
+        committed = SCENARIOS[name][1]
+        killed = process.exitcode == -signal.SIGKILL
+        ok = killed and found == expected and received == (AMOUNT * 100 if committed else 0)
+        print(f"{name}: {'killed' if killed else f'exit code {process.exitcode}'}, expected ${format_money(expected)}, "
+              f"found ${format_money(found)}, recipient got ${format_money(received)} - {'OK' if ok else 'FAILED'}")
+        return ok
+
+if __name__ == "__main__":
+    results = [run(name) for name in (sys.argv[1:] or SCENARIOS)]
+    sys.exit(0 if all(results) else 1)
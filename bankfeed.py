@@ -0,0 +1,176 @@
+from bankmetrics import count
+from contextlib import contextmanager, nullcontext
+import argparse
+import fcntl
+import json
+import os
+import sys
+import time
+import traceback
+
+# Change feed: every account change a storage commits is also appended to
+# a feed file as events, one JSON object per line, in commit order, so
+# downstream systems can follow the bank without reading its data files.
+#
+#   {"type": "account_created", "account_number", "version", "balance_cents", "time", "name", "username"}
+#   {"type": "transaction", ..., "seq", "kind", "amount_cents", "fee_cents", "txn_id", "counterparty"}
+#   {"type": "account_locked" | "account_unlocked", ...}
+#
+# balance_cents is the balance once the whole commit is applied; the legs of
+# one transfer share a txn_id. A consumer's position is a byte offset into
+# the feed, saved in its own offset file, so it resumes where it stopped.
+
+FEED_FILE = "bank_data.json.feed"
+POLL_INTERVAL = 0.5  # seconds a following consumer waits when it has caught up
+POLL_BATCH = 10000  # events read (and committed) at a time
+
+
+class EventFeed:
+    # Writer side. Each publish() is one locked append, so the lines of
+    # processes sharing the feed never interleave. In-process subscribers
+    # are called with the events published through this object, in order,
+    # but never while storage holds a lock: storage wraps its locks in
+    # deferring() and the events wait until the outermost block ends. A
+    # subscriber that raises is reported and skipped; the commit stands.
+    def __init__(self, path=FEED_FILE):
+        self.path = path
+        self.subscribers = []
+        self._file = None
+        self._held = False
+        self._deferring = 0
+        self._undelivered = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    @contextmanager
+    def hold(self):
+        # Keeps other processes from publishing, so a storage can commit
+        # inside and publish after its commit and still be in commit order.
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        fcntl.lockf(self._file, fcntl.LOCK_EX)
+        self._held = True
+        try:
+            yield
+        finally:
+            self._held = False
+            fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+    def publish(self, events):
+        if not events:
+            return
+        data = b"".join(json.dumps(event, separators=(",", ":")).encode() + b"\n" for event in events)
+        with nullcontext() if self._held else self.hold():
+            self._file.write(data)
+            self._file.flush()
+        count("feed.events", len(events))
+        count("feed.bytes", len(data))
+        if self.subscribers:
+            self._undelivered += events
+        if not self._deferring:
+            self.deliver()
+
+    @contextmanager
+    def deferring(self):
+        self._deferring += 1
+        try:
+            yield
+        finally:
+            self._deferring -= 1
+            if not self._deferring:
+                self.deliver()
+
+    def deliver(self):
+        events, self._undelivered = self._undelivered, []
+        if not events:
+            return
+        for callback in self.subscribers:
+            try:
+                callback(events)
+            except Exception:
+                count("feed.subscriber_errors")
+                traceback.print_exc()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class FeedConsumer:
+    # Reader side. poll() returns the events past the current offset and
+    # commit() saves it; a consumer started again with the same name picks
+    # up after the last committed event. A line still being written is left
+    # for the next poll.
+    def __init__(self, path=FEED_FILE, name="default", offset_path=None):
+        self.path = path
+        self.offset_path = offset_path or f"{path}.{name}.offset"
+        try:
+            with open(self.offset_path) as file:
+                self.offset = int(file.read() or 0)
+        except FileNotFoundError:
+            self.offset = 0
+
+    def poll(self, max_events=POLL_BATCH):
+        # [(offset, event)], offset being where the event's line starts.
+        events = []
+        try:
+            with open(self.path, "rb") as file:
+                file.seek(self.offset)
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    events.append((self.offset, json.loads(line)))
+                    self.offset += len(line)
+                    if len(events) == max_events:
+                        break
+        except FileNotFoundError:
+            pass
+        return events
+
+    def seek(self, offset):
+        self.offset = offset
+
+    def commit(self):
+        temp_file = self.offset_path + ".tmp"
+        with open(temp_file, "w") as file:
+            file.write(str(self.offset))
+        os.replace(temp_file, self.offset_path)
+
+    def follow(self, interval=POLL_INTERVAL, batch=POLL_BATCH):
+        # Yields events forever, committing after each batch is handed out.
+        while True:
+            events = self.poll(batch)
+            if not events:
+                time.sleep(interval)
+                continue
+            for offset, event in events:
+                yield event
+            self.commit()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the events of a bank's change feed as JSON lines.")
+    parser.add_argument("feed", nargs="?", default=FEED_FILE,
+                        help="feed file: <data file>.feed, or <shard directory>/feed (default: bank_data.json.feed)")
+    parser.add_argument("--consumer", default="default", help="name the saved offset is kept under")
+    parser.add_argument("--from-start", action="store_true", help="ignore the saved offset and read from the beginning")
+    parser.add_argument("--follow", action="store_true", help="keep waiting for new events")
+    args = parser.parse_args()
+    consumer = FeedConsumer(args.feed, args.consumer)
+    if args.from_start:
+        consumer.seek(0)
+    try:
+        if args.follow:
+            for event in consumer.follow():
+                sys.stdout.write(json.dumps(event) + "\n")
+                sys.stdout.flush()
+        else:
+            while True:
+                events = consumer.poll()
+                if not events:
+                    break
+                sys.stdout.write("".join(json.dumps(event) + "\n" for offset, event in events))
+                consumer.commit()
+    except KeyboardInterrupt:
+        pass
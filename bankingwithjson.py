@@ -1,246 +1,179 @@
-from tabulate import tabulate
-import random
-import json
+from bankcore import Bank, BankError
+from bankmoney import format_money
+from bankstatement import export_statement, format_time, parse_date
+from bankstorage import BALANCE_BUCKETS, open_storage
+from contextlib import nullcontext
+import argparse
+import bankmetrics
 
-DATA_FILE = "bank_data.json"
+# Console front end. All banking rules live in bankcore; this module only
+# reads input, calls the engine and prints what comes back.
 
-def load_data():
-    try:
-        with open(DATA_FILE, "r") as file:
-            return json.load(file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {"accounts": {}, "users": {}}
-
-def save_data(data):
-    with open(DATA_FILE, "w") as file:
-        json.dump(data, file, indent=4)
+HISTORY_PAGE_SIZE = 20
+ACCOUNT_PAGE_SIZE = 20
 
-class Account:
-    def __init__(self, name, username, password, pin, initial_balance=0, account_number=None, transaction_history=None,  locked=False, login_attempts=0, pin_attempts=0):
-        self.name = name
-        self.username = username
-        self.password = password
-        self.pin = pin
-        self.__account_number = account_number if account_number else random.randint(100000, 999999)
-        self.__balance = initial_balance
-        self.transaction_history = transaction_history if transaction_history else []
-        self.locked = locked
-        self.login_attempts = login_attempts
-        self.pin_attempts = pin_attempts
-        if not transaction_history:
-            self._log_transaction("Account created", initial_balance)
+def print_table(rows, headers):
+    from tabulate import tabulate  # imported on first use: it takes longer to load than the rest of the app
+    with bankmetrics.timer("render.table"):
+        # Cells are already formatted (format_money); parsed back into
+        # numbers they would lose their trailing zeros.
+        print(tabulate(rows, headers=headers, tablefmt="grid", disable_numparse=True))
 
-    def is_locked(self):
-        return self.locked
-    
-    def reset_attempts(self):
-        self.login_attempts = 0
-        self.pin_attempts = 0
-    
-    def deposit(self, amount):
-        if amount > 0:
-            self.__balance += amount
-            self._log_transaction("Deposit", amount, 0.0)
-            print(f"Deposited ${amount:.2f}. New balance: ${self.__balance:.2f}")
-        else:
-            print("Deposit amount must be positive.")
+def receipt_message(bank, receipt):
+    if receipt.kind == "deposit":
+        return f"Deposited ${format_money(receipt.amount)}. New balance: ${format_money(receipt.balance)}"
+    if receipt.kind == "withdrawal":
+        return f"Withdrew ${format_money(receipt.amount)} + ${format_money(receipt.fee)} fee. New balance: ${format_money(receipt.balance)}"
+    recipient = bank.get_account(receipt.counterparty)
+    return f"Transferred ${format_money(receipt.amount)} to {recipient.name} + ${format_money(receipt.fee)} fee. New balance: ${format_money(receipt.balance)}"
 
+def check_balance(bank, account):
+    print(f"Account Balance: ${format_money(bank.balance(account.get_account_number()))}")
 
-    def withdraw(self, amount):
-        if amount > 0 and amount <= self.__balance:
-            fee = amount * 0.015  # 1.5% withdrawal fee
-            total_amount = amount + fee
-            if total_amount <= self.__balance:
-                self.__balance -= total_amount
-                self._log_transaction("Withdrawal", amount, fee)
-                print(f"Withdrew ${amount:.2f} + ${fee:.2f} fee. New balance: ${self.__balance:.2f}")
-            else:
-                print("Insufficient funds including fee.")
-        elif amount > self.__balance:
-            print("Insufficient funds.")
-        else:
-            print("Withdrawal amount must be positive.")
+def read_date(prompt):
+    try:
+        return parse_date(input(prompt).strip())
+    except ValueError:
+        print("Invalid date, showing everything.")
+        return None
 
-    def transfer(self, recipient, amount, pin):
-        # if pin != self.pin:
-        #     print("Incorrect PIN. Transfer denied.")
-        #     return
-        if pin != self.pin:
-            self.pin_attempts += 1
-            if self.pin_attempts >= 3:
-                self.locked = True
-                print("Too many wrong PIN entries. Account has been locked.")
-            else:
-                print(f"Incorrect PIN,Transfer denied. {3 - self.pin_attempts} attempts left.")
-            return
-        else:
-            self.pin_attempts = 0
-        
-        if recipient == self:
-            print("You cannot transfer funds to your own account.")
+def show_transaction_history(bank, account):
+    # Newest first, one page at a time.
+    since = read_date("Show entries since (YYYY-MM-DD, blank for all): ")
+    cursor = None
+    while True:
+        page, cursor_next = bank.history_page(account.get_account_number(), HISTORY_PAGE_SIZE, cursor, since=since)
+        if not page and cursor is None:
+            print("No transactions yet.")
             return
-        
-        if amount > 0 and amount <= self.__balance:
-            fee = amount * 0.035  # 3.5% transfer fee
-            total_amount = amount + fee
-            if total_amount <= self.__balance:
-                self.__balance -= total_amount
-                recipient.__balance += amount
-                self._log_transaction(f"Transfer to {recipient.name}", amount, fee)
-                recipient._log_transaction(f"Received from {self.name}", amount, 0.0)
-                self._log_transaction("Transfer Fee", fee, fee)
-                print(f"Transferred ${amount:.2f} to {recipient.name} + ${fee:.2f} fee. New balance: ${self.__balance:.2f}")
-            else:
-                print("Insufficient funds including fee.")
-        else:
-            print("Insufficient funds or invalid amount.")
+        rows = [[format_time(entry.timestamp), entry.kind, format_money(entry.amount), format_money(entry.fee)] for seq, entry in page]
+        print_table(rows, ["Date", "Transaction Type", "Amount ($)", "Fee ($)"])
+        cursor = cursor_next
+        if cursor is None or input("Press Enter for older entries, or q to stop: ").strip().lower() == "q":
+            break
+    print(f"\nCurrent Balance: ${format_money(account.get_balance())}")
 
-    def check_balance(self):
-        print(f"Account Balance: ${self.__balance:.2f}")
-    
-    def show_transaction_history(self):
-        if self.transaction_history:
-            print(tabulate(self.transaction_history, headers=["Transaction Type", "Amount ($)", "Fee ($)"], tablefmt="grid"))
-            print(f"\nCurrent Balance: ${self.__balance:.2f}")
-        else:
-            print("No transactions yet.")
+def export_history(bank, account):
+    path = input("Save statement to (.csv or .jsonl): ").strip()
+    since = read_date("From date (YYYY-MM-DD, blank for all): ")
+    until = read_date("Up to but not including (YYYY-MM-DD, blank for all): ")
+    try:
+        count = export_statement(bank, account.get_account_number(), path, since=since, until=until)
+    except (OSError, ValueError) as error:
+        print(f"Could not write statement: {error}")
+        return
+    print(f"Exported {count} transactions to {path}")
 
-    def _log_transaction(self, transaction_type, amount, fee=0.0):
-        self.transaction_history.append([transaction_type, amount, fee])
-    
-    def get_account_number(self):
-        return self.__account_number
-    
-    def to_dict(self):
-        return {
-            "name": self.name,
-            "username": self.username,
-            "password": self.password,
-            "pin": self.pin,
-            "account_number": self.__account_number,
-            "balance": self.__balance,
-            "transaction_history": self.transaction_history,
-            "locked": self.locked,
-            "login_attempts": self.login_attempts,
-            "pin_attempts": self.pin_attempts
-        }
+def read_amount(prompt):
+    text = input(prompt).strip()
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        print("Invalid amount, ignoring it.")
+        return None
 
-class Bank:
-    def __init__(self):
-        data = load_data()
-        self.admin_credentials = {"admin": "admin123"}
-        self.accounts = {
-            int(acc_num): Account(
-                name=acc_data["name"],
-                username=acc_data["username"],
-                password=acc_data["password"],
-                pin=acc_data["pin"],
-                initial_balance=acc_data["balance"],
-                account_number=acc_num,
-                transaction_history=acc_data.get("transaction_history", [])
-            )
-            for acc_num, acc_data in data["accounts"].items()
-        }
-        self.users = data["users"]
-    
-    def create_account(self, name, username, password, pin, initial_balance):
-        if username in self.users:
-            print("Username already exists. Choose a different username.")
-            return None
-        new_account = Account(name, username, password, pin, initial_balance)
-        self.accounts[new_account.get_account_number()] = new_account
-        self.users[username] = (password, new_account.get_account_number())
-        self.save()
-        print(f"Account created successfully! Account Number: {new_account.get_account_number()}")
-        return new_account
-    
-    # def login(self, username, password):
-    #     if username in self.users and self.users[username][0] == password:
-    #         account_number = self.users[username][1]
-    #         return self.accounts.get(account_number, None)
-    #     else:
-    #         print("Invalid username or password.")
-    #         return None
-    def login(self, username, password):
-        if username in self.users:
-            account_number = self.users[username][1]
-            account = self.accounts.get(account_number)
+def display_all_accounts(bank, **filters):
+    # One page at a time; filters are passed on to Bank.account_page.
+    cursor = None
+    while True:
+        page, cursor_next = bank.account_page(ACCOUNT_PAGE_SIZE, cursor, **filters)
+        if not page and cursor is None:
+            print("No accounts found.")
+            return
+        account_list = [[acc["account_number"], acc["name"], acc["username"], format_money(acc["balance_cents"]),
+                         "Locked" if acc["locked"] else "Active"] for acc in page]
+        print_table(account_list, ["Account Number", "Name", "Username", "Balance", "Status"])
+        cursor = cursor_next
+        if cursor is None or input("Press Enter for the next page, or q to stop: ").strip().lower() == "q":
+            break
 
-            if account.is_locked():
-                print("Account is locked. Contact admin to unlock.")
-                return None
+def browse_accounts(bank):
+    sort = "balance" if input("Sort by 1. Account number or 2. Balance: ").strip() == "2" else "account_number"
+    descending = input("Highest first? (y/n): ").strip().lower() == "y"
+    locked = True if input("Locked accounts only? (y/n): ").strip().lower() == "y" else None
+    min_balance = read_amount("Minimum balance (blank for none): ")
+    max_balance = read_amount("Maximum balance (blank for none): ")
+    display_all_accounts(bank, sort=sort, descending=descending, locked=locked, min_balance=min_balance,
+                         max_balance=max_balance)
 
-            if account.password == password:
-                account.reset_attempts()
-                self.save()
-                return account
-            else:
-                account.login_attempts += 1
-                if account.login_attempts >= 3:
-                    account.locked = True
-                    print("Too many failed login attempts. Account has been locked.")
-                else:
-                    print(f"Invalid password. {3 - account.login_attempts} attempts left.")
-                self.save()
-                return None
+def show_overview(bank):
+    stats = bank.overview()
+    print(f"Accounts: {stats['accounts']}  Locked: {stats['locked_accounts']}  "
+          f"Total balance: ${format_money(stats['balance_cents'])}")
+    bounds = [None, *BALANCE_BUCKETS, None]
+    rows = []
+    for i, (low, high) in enumerate(zip(bounds, bounds[1:])):
+        if low is None:
+            label = f"under ${format_money(high)}"
+        elif high is None:
+            label = f"${format_money(low)} and up"
         else:
-            print("Username not found.")
-            return None
-    
-    def admin_menu(self):
-        while True:
-            print("\n--- Admin Menu ---")
-            print("1. Unlock User Account")
-            print("2. View All Accounts")
-            print("3. Exit Admin Menu")
-            choice = input("Enter your choice: ")
+            label = f"${format_money(low)} to ${format_money(high)}"
+        rows.append([label, stats[f"balance_bucket_{i}"]])
+    print_table(rows, ["Balance", "Accounts"])
 
-            if choice == "1":
-                acc_num = int(input("Enter account number to unlock: "))
-                account = self.get_account(acc_num)
-                if account and account.is_locked():
-                    account.locked = False
-                    account.reset_attempts()
-                    self.save()
-                    print("Account unlocked successfully.")
-                else:
-                    print("Account not found or not locked.")
-            elif choice == "2":
-                self.display_all_accounts()
-            elif choice == "3":
-                print("Exiting admin menu.")
-                break
-            else:
-                print("Invalid choice.")
-    def admin_login(self):
-        username = input("Enter admin username: ")
-        password = input("Enter admin password: ")
-        if self.admin_credentials.get(username) == password:
-            print("Admin logged in.")
-            self.admin_menu()
-        else:
-            print("Invalid admin credentials.")
+def show_metrics():
+    if not bankmetrics.enabled:
+        print("Metrics are off; start the program with --metrics to collect them.")
+        return
+    stats = bankmetrics.snapshot()
+    rows = [[name, histogram["count"], f"{histogram['sum'] / histogram['count'] * 1000:.2f}",
+             f"{histogram['p50'] * 1000:g}", f"{histogram['p99'] * 1000:g}"]
+            for name, histogram in sorted(stats["histograms"].items()) if histogram["count"]]
+    print_table(rows, ["Operation", "Calls", "Mean (ms)", "p50 under (ms)", "p99 under (ms)"])
+    print_table(sorted(stats["counters"].items()), ["Counter", "Value"])
+    path = input("Save metrics to (.json or .prom, blank to skip): ").strip()
+    if path:
+        try:
+            bankmetrics.write_metrics(path)
+            print(f"Metrics saved to {path}")
+        except OSError as error:
+            print(f"Could not write metrics: {error}")
 
+def admin_menu(bank):
+    while True:
+        print("\n--- Admin Menu ---")
+        print("1. Unlock User Account")
+        print("2. View All Accounts")
+        print("3. Account Overview")
+        print("4. Metrics")
+        print("5. Exit Admin Menu")
+        choice = input("Enter your choice: ")
 
-    def get_account(self, account_number):
-        return self.accounts.get(account_number, None)
-    
-    def display_all_accounts(self):
-        if not self.accounts:
-            print("No accounts found.")
-            return
-        account_list = [[acc.get_account_number(), acc.name, acc.username, acc.to_dict()["balance"],"Locked" if acc.is_locked() else "Active"] for acc in self.accounts.values()]
-        print(tabulate(account_list, headers=["Account Number", "Name", "Username", "Balance", "Status"], tablefmt="grid"))
-    
-    def save(self):
-        data = {
-            "accounts": {acc_num: acc.to_dict() for acc_num, acc in self.accounts.items()},
-            "users": self.users
-        }
-        save_data(data)
+        if choice == "1":
+            acc_num = int(input("Enter account number to unlock: "))
+            try:
+                bank.unlock(acc_num)
+                print("Account unlocked successfully.")
+            except BankError:
+                print("Account not found or not locked.")
+        elif choice == "2":
+            browse_accounts(bank)
+        elif choice == "3":
+            show_overview(bank)
+        elif choice == "4":
+            show_metrics()
+        elif choice == "5":
+            print("Exiting admin menu.")
+            break
+        else:
+            print("Invalid choice.")
+
+def admin_login(bank):
+    username = input("Enter admin username: ")
+    password = input("Enter admin password: ")
+    try:
+        bank.check_admin(username, password)
+    except BankError as error:
+        print(error)
+        return
+    print("Admin logged in.")
+    admin_menu(bank)
 
-def main():
-    bank = Bank()
+def main(storage=None, lazy=False):
+    bank = Bank(storage, lazy)
     while True:
         print("\n--- Banking System ---")
         print("1. Create Account")
@@ -257,11 +190,19 @@ def main():
             password = input("Choose a password: ")
             pin = input("Enter a 4-digit PIN: ")
             initial_balance = float(input("Enter initial balance: "))
-            bank.create_account(name, username, password, pin, initial_balance)
+            try:
+                new_account = bank.create_account(name, username, password, pin, initial_balance)
+                print(f"Account created successfully! Account Number: {new_account.get_account_number()}")
+            except BankError as error:
+                print(error)
         elif choice == "2":
             username = input("Enter your username: ")
             password = input("Enter your password: ")
-            account = bank.login(username, password)
+            try:
+                account = bank.login(username, password)
+            except BankError as error:
+                print(error)
+                account = None
             if account:
                 while True:
                     print("\n--- Account Menu ---")
@@ -270,45 +211,66 @@ def main():
                     print("3. Transfer Funds")
                     print("4. Check Balance")
                     print("5. Transaction History")
-                    print("6. Logout")
+                    print("6. Export Statement")
+                    print("7. Logout")
                     
                     action = input("Enter your choice: ")
-                    if action == "1":
-                        amount = float(input("Enter deposit amount: "))
-                        account.deposit(amount)
-                        bank.save()
-                    elif action == "2":
-                        amount = float(input("Enter withdrawal amount: "))
-                        account.withdraw(amount)
-                        bank.save()
-                    elif action == "3":
-                        recipient_number = int(input("Enter recipient account number: "))
-                        recipient = bank.get_account(recipient_number)
-                        if recipient:
-                            amount = float(input("Enter transfer amount: "))
-                            pin = input("Enter your PIN: ")
-                            account.transfer(recipient, amount, pin)
-                            bank.save()
+                    try:
+                        if action == "1":
+                            amount = float(input("Enter deposit amount: "))
+                            print(receipt_message(bank, bank.deposit(account.get_account_number(), amount)))
+                        elif action == "2":
+                            amount = float(input("Enter withdrawal amount: "))
+                            print(receipt_message(bank, bank.withdraw(account.get_account_number(), amount)))
+                        elif action == "3":
+                            recipient_number = int(input("Enter recipient account number: "))
+                            recipient = bank.get_account(recipient_number)
+                            if recipient:
+                                amount = float(input("Enter transfer amount: "))
+                                pin = input("Enter your PIN: ")
+                                print(receipt_message(bank, bank.transfer(account.get_account_number(), recipient_number, amount, pin)))
+                            else:
+                                print("Recipient account not found.")
+                        elif action == "4":
+                            check_balance(bank, account)
+                        elif action == "5":
+                            show_transaction_history(bank, account)
+                        elif action == "6":
+                            export_history(bank, account)
+                        elif action == "7":
+                            print("Logging out...")
+                            break
                         else:
-                            print("Recipient account not found.")
-                    elif action == "4":
-                        account.check_balance()
-                    elif action == "5":
-                        account.show_transaction_history()
-                    elif action == "6":
-                        print("Logging out...")
-                        break
-                    else:
-                        print("Invalid choice. Please try again.")
+                            print("Invalid choice. Please try again.")
+                    except BankError as error:
+                        print(error)
         elif choice == "3":
-            bank.display_all_accounts()
+            display_all_accounts(bank)
         elif choice == "4":
-            bank.admin_login()
+            admin_login(bank)
         elif choice == "5":
+            bank.close()
             print("Exiting... Goodbye!")
             break
         else:
             print("Invalid choice. Please try again.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Console banking app.")
+    parser.add_argument("storage", nargs="?", help="a JSON file, .bin snapshot, SQLite database or shard directory "
+                                                   "(default: bank_data.json). A JSON file is parsed in full on the "
+                                                   "first login or listing; convert it with banksnapshot.py for one "
+                                                   "that stays fast as the bank grows")
+    parser.add_argument("--metrics", action="store_true", help="collect timings and counters (see the admin menu)")
+    parser.add_argument("--profile", metavar="PATH", help="write cProfile stats of the session to PATH and "
+                                                            "its largest allocations to PATH.mem.txt")
+    args = parser.parse_args()
+    bankmetrics.enable(args.metrics)
+    # Every storage is opened lazily: the menu appears before anything is
+    # read, and accounts and histories are decoded as they are used. A .bin
+    # snapshot or SQLite database answers the first login in the same time
+    # whatever its size and shards are read one at a time as they are
+    # needed, but a JSON file is read whole on the first login or listing.
+    storage = open_storage(args.storage)
+    with bankmetrics.profile_session(args.profile) if args.profile else nullcontext():
+        main(storage, lazy=True)
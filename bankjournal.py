@@ -0,0 +1,117 @@
+from bankmetrics import count, timer
+import json
+import os
+import threading
+
+FSYNC_POLICIES = ("always", "group", "timer")
+
+
+def record_count(line):
+    # A line is one record or the list of records committed together.
+    return len(line) if isinstance(line, list) else 1
+
+
+class Journal:
+    # Append-only log of small JSON records, one per line (or one list of
+    # records per line); self.records counts records, not lines.
+    # fsync_policy decides when records are forced to disk:
+    #   "always" - after every record
+    #   "group"  - once every group_size records
+    #   "timer"  - at most interval seconds after a record is written
+    def __init__(self, path, fsync_policy="group", group_size=64, interval=1.0):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.group_size = group_size
+        self.interval = interval
+        self.records = 0
+        self.pending = 0
+        self.offset = 0  # bytes of the file already replayed
+        self._lock = threading.Lock()
+        self._timer = None
+        self._file = None
+
+    def replay(self):
+        # Yields every complete record past self.offset, so calling it again
+        # picks up what other processes appended since. A torn last line
+        # (crash mid-write) is cut off so new records are not appended after
+        # garbage; callers must hold the bank's write lock.
+        good_offset = self.offset
+        try:
+            with open(self.path, "rb") as file:
+                file.seek(self.offset)
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    good_offset += len(line)
+                    self.offset = good_offset
+                    self.records += record_count(record)
+                    yield record
+        except FileNotFoundError:
+            return
+        if os.path.getsize(self.path) != good_offset:
+            with open(self.path, "r+b") as file:
+                file.truncate(good_offset)
+
+    def reset(self):
+        self.offset = 0
+        self.records = 0
+
+    def open(self):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+
+    def append(self, record):
+        self.open()
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        count("journal.appends")
+        count("journal.bytes", len(line))
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.offset = self._file.tell()
+            self.records += record_count(record)
+            self.pending += 1
+            if self.fsync_policy == "always":
+                self._sync()
+            elif self.fsync_policy == "group" and self.pending >= self.group_size:
+                self._sync()
+        if self.fsync_policy == "timer" and self._timer is None:
+            self._timer = threading.Timer(self.interval, self.sync)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def sync(self):
+        with self._lock:
+            self._timer = None
+            self._sync()
+
+    def _sync(self):
+        if self._file is not None and self.pending:
+            self._file.flush()
+            with timer("journal.fsync"):
+                os.fsync(self._file.fileno())
+        self.pending = 0
+
+    def truncate(self):
+        # Called after a checkpoint has folded every record into the snapshot.
+        with self._lock:
+            self.open()
+            self._file.truncate(0)
+            self._file.seek(0)
+            self.offset = 0
+            self.records = 0
+            self.pending = 0
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self.sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
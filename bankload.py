@@ -0,0 +1,66 @@
+from bankserver import HOST, PORT
+import argparse
+import asyncio
+import json
+import random
+import time
+
+# Load generator for bankserver.py: each client opens its own connection,
+# creates and logs into an account, then fires a random mix of operations.
+
+async def run_client(host, port, run_id, index, operations, latencies, account_numbers, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def call(**request):
+        started = time.perf_counter()
+        writer.write(json.dumps(request).encode() + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        latencies.append(time.perf_counter() - started)
+        if not response["ok"]:
+            errors[response["error"]] = errors.get(response["error"], 0) + 1
+        return response
+
+    username = f"load-{run_id}-{index}"
+    created = await call(op="create_account", name=f"Load {index}", username=username,
+                         password="secret", pin="1234", initial_balance=1000)
+    account_numbers.append(created["result"]["account_number"])
+    session = (await call(op="login", username=username, password="secret"))["result"]["session"]
+    rng = random.Random(index)
+    for _ in range(operations):
+        choice = rng.random()
+        if choice < 0.3:
+            await call(op="deposit", session=session, amount=rng.randint(1, 50))
+        elif choice < 0.5:
+            await call(op="withdraw", session=session, amount=rng.randint(1, 20))
+        elif choice < 0.8 and len(account_numbers) > 1:
+            await call(op="transfer", session=session, to=rng.choice(account_numbers), amount=rng.randint(1, 20), pin="1234")
+        else:
+            await call(op="balance", session=session)
+    await call(op="logout", session=session)
+    writer.close()
+    await writer.wait_closed()
+
+async def run(host, port, clients, operations):
+    run_id = f"{int(time.time())}-{random.randint(0, 9999)}"
+    latencies = []
+    account_numbers = []
+    errors = {}
+    started = time.perf_counter()
+    await asyncio.gather(*(run_client(host, port, run_id, i, operations, latencies, account_numbers, errors)
+                           for i in range(clients)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"{len(latencies)} requests from {clients} clients in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} req/s)")
+    print(f"latency p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms")
+    if errors:
+        print("errors: " + ", ".join(f"{name} x{count}" for name, count in sorted(errors.items())))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate load against bankserver.py.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--operations", type=int, default=200, help="operations per client")
+    args = parser.parse_args()
+    asyncio.run(run(args.host, args.port, args.clients, args.operations))
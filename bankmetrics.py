@@ -0,0 +1,149 @@
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+import functools
+import json
+import time
+
+# In-process metrics: counters and latency histograms, off until enable() is
+# called. While off, every hook is one check of a module flag. Names are
+# dotted ("bank.login", "storage.lock_wait"); counters ending in "bytes"
+# count bytes. Read them with snapshot(), as JSON or as Prometheus text.
+#
+# A profile_session() additionally records cProfile stats and the largest
+# memory allocations (tracemalloc) of everything run inside it.
+
+# Histogram bucket upper bounds in seconds; the last bucket has no bound.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+enabled = False
+counters = {}
+histograms = {}  # name -> [count per bucket..., sum of seconds]
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def reset():
+    counters.clear()
+    histograms.clear()
+
+def count(name, amount=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + amount
+
+def observe(name, seconds):
+    if enabled:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = [0] * (len(BUCKETS) + 1) + [0.0]
+        histogram[bisect_left(BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+def timed(name):
+    # Decorator: a latency histogram for every call of the function.
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+def timer(name):
+    # Context manager form of timed() for a block of code.
+    return _timer(name) if enabled else nullcontext()
+
+@contextmanager
+def _timer(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started)
+
+def quantile(histogram, fraction):
+    # The upper bound of the bucket holding the given fraction of calls.
+    total = sum(histogram[:-1])
+    seen = 0
+    for bound, calls in zip(BUCKETS + (float("inf"),), histogram):
+        seen += calls
+        if total and seen >= fraction * total:
+            return bound
+    return 0.0
+
+def snapshot():
+    result = {"counters": dict(counters), "histograms": {}}
+    for name, histogram in histograms.items():
+        calls = sum(histogram[:-1])
+        result["histograms"][name] = {
+            "count": calls, "sum": histogram[-1], "p50": quantile(histogram, 0.5), "p99": quantile(histogram, 0.99),
+            "buckets": {str(bound): calls for bound, calls in zip(BUCKETS + ("+Inf",), histogram)}}
+    for hits, misses, rate in _cache_rates():
+        result["counters"][rate] = counters.get(hits, 0) / (counters.get(hits, 0) + counters.get(misses, 0))
+    return result
+
+def dump_json():
+    return json.dumps(snapshot(), indent=2)
+
+def dump_prometheus():
+    # Prometheus text exposition format: counters as bank_<name>_total and
+    # histograms as bank_<name>_seconds with cumulative buckets (dots become
+    # underscores and names already starting with "bank." keep one prefix).
+    lines = []
+    for name, value in sorted(counters.items()):
+        metric = _metric_name(name) + "_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+    for name, histogram in sorted(histograms.items()):
+        metric = _metric_name(name) + "_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, calls in zip(BUCKETS + ("+Inf",), histogram):
+            cumulative += calls
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines += [f"{metric}_sum {histogram[-1]}", f"{metric}_count {cumulative}"]
+    return "\n".join(lines) + "\n"
+
+def write_metrics(path):
+    # Prometheus text for a .prom or .txt path, JSON otherwise.
+    with open(path, "w") as file:
+        file.write(dump_prometheus() if path.endswith((".prom", ".txt")) else dump_json())
+
+def _metric_name(name):
+    name = name.replace(".", "_")
+    return name if name.startswith("bank_") else "bank_" + name
+
+def _cache_rates():
+    # (hits counter, misses counter, rate name) for every cache seen so far.
+    for name in list(counters):
+        if name.endswith(".hits"):
+            prefix = name[:-len(".hits")]
+            yield name, prefix + ".misses", prefix + ".hit_rate"
+
+@contextmanager
+def profile_session(path, top=30):
+    # cProfile stats go to path (python -m pstats path) and the top
+    # allocation sites by size to path + ".mem.txt". Metrics are on inside.
+    import cProfile  # only profiled runs pay for loading the profilers
+    import tracemalloc
+    was_enabled = enabled
+    enable()
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        memory = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        enable(was_enabled)
+        profiler.dump_stats(path)
+        with open(path + ".mem.txt", "w") as file:
+            for stat in memory.statistics("lineno")[:top]:
+                file.write(f"{stat}\n")
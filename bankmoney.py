@@ -0,0 +1,37 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+# Money is kept as whole cents (int) everywhere below the user interface.
+# Dollar amounts coming in are rounded half-up to the cent exactly once, here.
+
+WITHDRAWAL_FEE_PER_MILLE = 15  # 1.5%
+TRANSFER_FEE_PER_MILLE = 35  # 3.5%
+
+def to_cents(amount):
+    # str() first so a float like 54.22499999999999 rounds by its printed value.
+    value = Decimal(str(amount))
+    if not value.is_finite():
+        raise ValueError(f"Not a finite amount: {amount}")
+    return int((value * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def fee_cents(cents, per_mille):
+    # Half-up rounding in pure integer arithmetic (amounts are never negative here).
+    return (cents * per_mille + 500) // 1000
+
+def format_money(cents):
+    sign = "-" if cents < 0 else ""
+    cents = abs(cents)
+    return f"{sign}{cents // 100}.{cents % 100:02d}"
+
+def upgrade_account_data(acc_data):
+    # Files written before money was stored in cents have a float "balance"
+    # and float amounts in the history; convert them in place.
+    if "balance_cents" in acc_data:
+        return acc_data
+    acc_data["balance_cents"] = to_cents(acc_data.pop("balance", 0))
+    history = acc_data.get("transaction_history")
+    if history:
+        history[:] = [upgrade_entry(entry) for entry in history]
+    return acc_data
+
+def upgrade_entry(entry):
+    return [entry[0], to_cents(entry[1]), to_cents(entry[2]) if len(entry) > 2 else 0]
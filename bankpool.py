@@ -0,0 +1,307 @@
+from bankallocator import AccountNumberAllocator
+from bankcore import Bank, BankError, UsernameTakenError
+from banksecurity import hash_secret, is_hashed
+from bankfeed import EventFeed
+from bankshard import ShardedStorage, shard_journal_path, shard_path
+from bankstorage import JsonStorage, bump_counter
+from multiprocessing.connection import wait
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+# Process-pool execution: one worker process per shard of a ShardedStorage
+# directory, each the only user of its shard, so operations on different
+# shards run on different cores. BankPool.run takes a batch of operations
+#
+#   ("create", name, username, password, pin, initial_balance)
+#   ("deposit" | "withdraw", account_number, amount)
+#   ("transfer", from, to, amount, pin)
+#   ("balance", account_number)
+#
+# and returns one result per operation (a Receipt, a new account number, a
+# balance in cents, or the BankError it raised). Within a batch, operations
+# on one shard run in order and shards run in parallel; transfers between
+# shards are applied after the rest of the batch.
+#
+# A transfer between shards is a handoff in three rounds:
+#   1. prepare: both workers confirm their account and return its name
+#   2. debit:   the sender's worker checks the PIN and funds and takes the
+#               money, legs stamped with a txn_id chosen by the router
+#   3. credit:  the recipient's worker adds it; crediting a txn_id twice is
+#               a no-op
+# New accounts get their number from the directory's allocator (see
+# bankallocator) in the router and live in the shard of that number; their
+# usernames are first checked against every shard in one round.
+#
+# Before round 2 the router fsyncs every handoff to handoffs.jsonl. If the
+# router dies before a handoff is marked done, the next BankPool on the
+# directory asks the sender's worker whether the debit happened and, if so,
+# finishes the credit. Money is never created or lost.
+
+def run_op(bank, op):
+    kind, args = op[0], op[1:]
+    try:
+        if kind == "create":
+            # Secrets already hashed (made once for many accounts) are stored as they are.
+            name, username, password, pin, initial_balance, account_number = args
+            return bank.create_account(name, username, password, pin, initial_balance, account_number,
+                                       hashed=is_hashed(password) and is_hashed(pin)).get_account_number()
+        if kind == "has_user":
+            return bank.find_user(args[0]) is not None
+        if kind == "deposit":
+            return bank.deposit(*args)
+        if kind == "withdraw":
+            return bank.withdraw(*args)
+        if kind == "transfer":
+            return bank.transfer(*args)
+        if kind == "balance":
+            return bank.balance(*args)
+        if kind == "prepare":
+            return bank.require_account(*args).name
+        if kind == "debit":
+            return bank.send_transfer(*args)
+        if kind == "credit":
+            return bank.receive_transfer(*args)
+        if kind == "debited":
+            # Recovery: the debit leg of a handoff, if it was written.
+            txn_id, sender_number = args
+            for acc_num, seq, entry in bank.find_transaction(txn_id):
+                if acc_num == sender_number and entry.counterparty is not None:
+                    return entry.amount, bank.require_account(sender_number).name
+            return None
+        raise ValueError(f"Unknown operation: {kind}")
+    except BankError as error:
+        return error
+
+def worker_main(directory, index, conn, journal, fsync_policy):
+    storage = JsonStorage(shard_path(directory, index), shard_journal_path(directory, index), journal, fsync_policy,
+                          os.path.join(directory, "txn"), EventFeed(os.path.join(directory, "feed")))
+    bank = Bank(storage, lazy=True)
+    router = multiprocessing.parent_process()
+    while True:
+        # A router killed mid-batch never sends None, and the other workers
+        # hold its end of this pipe open, so watch the router itself too.
+        if conn not in wait([conn, router.sentinel]):
+            break
+        ops = conn.recv()
+        if ops is None:
+            break
+        conn.send([run_op(bank, op) for op in ops])
+    bank.close()
+
+
+class BankPool:
+    def __init__(self, directory, workers=None, journal=True, fsync_policy="group"):
+        # The directory is an ordinary shard directory (see bankshard); its
+        # shard count is the number of workers.
+        storage = ShardedStorage(directory, workers, journal, fsync_policy)
+        self.partitions = len(storage.shards)
+        storage.close()
+        self.directory = directory
+        self.handoff_path = os.path.join(directory, "handoffs.jsonl")
+        self.allocator = AccountNumberAllocator(os.path.join(directory, "alloc"))
+        self.conns = []
+        self.processes = []
+        for index in range(self.partitions):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=worker_main, args=(directory, index, child, journal, fsync_policy),
+                                              daemon=True)
+            process.start()
+            self.conns.append(parent)
+            self.processes.append(process)
+        self._recover()
+
+    def partition(self, account_number):
+        return int(account_number) % self.partitions
+
+    def run(self, ops):
+        ops = list(ops)
+        results = [None] * len(ops)
+        batches = [[] for _ in range(self.partitions)]
+        handoffs = {}  # position -> [from, to, amount, pin], txn_id appended later
+        creates = self._free_usernames(ops, results)
+        for position, op in enumerate(ops):
+            if op[0] == "create":
+                if position in creates:
+                    account_number = self.allocator.allocate()
+                    batches[self.partition(account_number)].append((position, op + (account_number,)))
+            elif op[0] == "transfer" and self.partition(op[1]) != self.partition(op[2]):
+                handoffs[position] = list(op[1:])
+            else:
+                batches[self.partition(op[1])].append((position, op))
+        self._dispatch(batches, results)
+        if handoffs:
+            self._handoff(handoffs, results)
+        return results
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+
+    def _dispatch(self, batches, results):
+        # batches holds one list of (key, op) per worker; replies are stored
+        # in results under each key. Every worker gets its batch before any
+        # reply is read, so the batches run in parallel.
+        for conn, batch in zip(self.conns, batches):
+            if batch:
+                conn.send([op for key, op in batch])
+        for conn, batch in zip(self.conns, batches):
+            if batch:
+                for (key, op), result in zip(batch, conn.recv()):
+                    results[key] = result
+
+    def _free_usernames(self, ops, results):
+        # Positions of the creates whose username is taken neither in any
+        # shard nor by an earlier create in the batch; the rest get an error.
+        usernames = {}
+        for position, op in enumerate(ops):
+            if op[0] == "create":
+                usernames.setdefault(op[2], []).append(position)
+        if not usernames:
+            return set()
+        found = {}
+        self._dispatch([[((username, index), ("has_user", username)) for username in usernames]
+                        for index in range(self.partitions)], found)
+        creates = set()
+        for username, positions in usernames.items():
+            taken = any(found[username, index] for index in range(self.partitions))
+            if not taken:
+                creates.add(positions[0])
+            for position in positions if taken else positions[1:]:
+                results[position] = UsernameTakenError("Username already exists. Choose a different username.")
+        return creates
+
+    def _handoff(self, handoffs, results):
+        names = {}
+        batches = [[] for _ in range(self.partitions)]
+        for position, (sender, recipient, amount, pin) in handoffs.items():
+            batches[self.partition(sender)].append(((position, "from"), ("prepare", sender)))
+            batches[self.partition(recipient)].append(((position, "to"), ("prepare", recipient)))
+        self._dispatch(batches, names)
+
+        prepared = {}
+        for position, handoff in handoffs.items():
+            error = next((names[position, side] for side in ("from", "to") if isinstance(names[position, side], BankError)), None)
+            if error is None:
+                prepared[position] = handoff
+            else:
+                results[position] = error
+        if not prepared:
+            return
+        first_id = bump_counter(os.path.join(self.directory, "txn"), count=len(prepared))
+        for txn_id, handoff in enumerate(prepared.values(), first_id):
+            handoff.append(txn_id)
+        self._log_handoffs([{"txn_id": txn_id, "from": sender, "to": recipient}
+                            for sender, recipient, amount, pin, txn_id in prepared.values()])
+
+        batches = [[] for _ in range(self.partitions)]
+        for position, (sender, recipient, amount, pin, txn_id) in prepared.items():
+            batches[self.partition(sender)].append(
+                (position, ("debit", sender, recipient, names[position, "to"], amount, pin, txn_id)))
+        self._dispatch(batches, results)
+
+        batches = [[] for _ in range(self.partitions)]
+        for position, (sender, recipient, amount, pin, txn_id) in prepared.items():
+            receipt = results[position]
+            if not isinstance(receipt, BankError):
+                batches[self.partition(recipient)].append(
+                    (position, ("credit", recipient, sender, names[position, "from"], receipt.amount, txn_id)))
+        self._dispatch(batches, {})
+        self._log_handoffs([{"done": [handoff[4] for handoff in prepared.values()]}], sync=False)
+
+    def _log_handoffs(self, lines, sync=True):
+        with open(self.handoff_path, "a") as file:
+            file.write("".join(json.dumps(line) + "\n" for line in lines))
+            file.flush()
+            if sync:
+                os.fsync(file.fileno())
+
+    def _recover(self):
+        # Finishes the handoffs a previous router left open, then starts the
+        # log over.
+        pending = {}
+        try:
+            with open(self.handoff_path) as file:
+                for line in file:
+                    try:
+                        line = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if "done" in line:
+                        for txn_id in line["done"]:
+                            pending.pop(txn_id, None)
+                    else:
+                        pending[line["txn_id"]] = line
+        except FileNotFoundError:
+            return
+        for txn_id, handoff in pending.items():
+            results = {}
+            batches = [[] for _ in range(self.partitions)]
+            batches[self.partition(handoff["from"])].append((0, ("debited", txn_id, handoff["from"])))
+            self._dispatch(batches, results)
+            if results[0] is not None and not isinstance(results[0], BankError):
+                cents, sender_name = results[0]
+                batches = [[] for _ in range(self.partitions)]
+                batches[self.partition(handoff["to"])].append(
+                    (0, ("credit", handoff["to"], handoff["from"], sender_name, cents, txn_id)))
+                self._dispatch(batches, {})
+        os.remove(self.handoff_path)
+
+
+def benchmark(worker_counts, accounts, operations, batch_size, seed=0):
+    # The same random workload against a fresh pool of each size. Each row
+    # also checks that every cent is accounted for afterwards.
+    rng = random.Random(seed)
+    password, pin = hash_secret("secret"), hash_secret("1234")  # once, not per account
+    creates = [("create", f"User {i}", f"user{i}", password, pin, 1000) for i in range(accounts)]
+    choices = [rng.random() for _ in range(operations)]
+    picks = [(rng.random(), rng.random(), rng.randint(1, 50)) for _ in range(operations)]
+    rows = []
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            pool = BankPool(directory, workers)
+            numbers = []
+            for start in range(0, accounts, batch_size):
+                numbers += pool.run(creates[start:start + batch_size])
+            ops = []
+            for choice, (a, b, amount) in zip(choices, picks):
+                sender, recipient = numbers[int(a * accounts)], numbers[int(b * accounts)]
+                if choice < 0.3:
+                    ops.append(("deposit", sender, amount))
+                elif choice < 0.5:
+                    ops.append(("withdraw", sender, amount))
+                else:
+                    ops.append(("transfer", sender, recipient, amount, "1234"))
+            expected = accounts * 1000 * 100
+            started = time.perf_counter()
+            for start in range(0, operations, batch_size):
+                batch = ops[start:start + batch_size]
+                for op, result in zip(batch, pool.run(batch)):
+                    if isinstance(result, BankError):
+                        continue
+                    if op[0] == "deposit":
+                        expected += result.amount
+                    else:
+                        expected -= result.fee + (result.amount if op[0] == "withdraw" else 0)
+            elapsed = time.perf_counter() - started
+            found = sum(pool.run([("balance", number) for number in numbers]))
+            pool.close()
+        rows.append({"workers": workers, "ops_per_s": operations / elapsed, "ok": found == expected})
+        print(f"{workers:>3} workers  {operations / elapsed:10.0f} ops/s  money {'OK' if found == expected else 'MISMATCH'}")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the process-pool engine at several worker counts.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--accounts", type=int, default=2000)
+    parser.add_argument("--operations", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=1000, help="operations sent to the pool per run() call")
+    args = parser.parse_args()
+    print(f"{os.cpu_count()} CPUs")
+    benchmark(sorted(set(args.workers)), args.accounts, args.operations, args.batch)
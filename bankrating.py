@@ -0,0 +1,179 @@
+from bankcore import Bank
+from bankmoney import format_money
+from bankstorage import ACCOUNT_FIELDS, ConflictError, make_entry, open_storage
+from bisect import bisect_right
+from collections import namedtuple
+from contextlib import contextmanager
+import argparse
+import fcntl
+import json
+import os
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# End-of-period batch runs: monthly interest and maintenance fees for every
+# account. Balances are pulled into one column, the interest and fee for the
+# whole column are computed at once (with NumPy when it is installed), and
+# every changed account is written in a single storage commit. All the
+# entries of one run share one txn_id.
+#
+# Each run is for a period ("YYYY-MM"); storage.rating_path remembers the
+# last one rated, and a period up to it is refused, so a month is never
+# charged twice. The run's txn_id is noted there before its commit: if the
+# process dies before marking the period done, the next run looks the
+# txn_id up to tell whether the commit happened.
+#
+# A tier table is a list of (lowest balance in cents, value) in balance
+# order; an account gets the value of the last tier its balance reaches.
+RateSchedule = namedtuple("RateSchedule", "interest_tiers fee_tiers")
+# Interest in basis points a year: none under $1,000, 0.5% under $10,000, 1.5% above.
+# Maintenance fee in cents a month: $5 under $500, $2 under $2,500, free above.
+DEFAULT_SCHEDULE = RateSchedule([(0, 0), (100000, 50), (1000000, 150)], [(0, 500), (50000, 200), (250000, 0)])
+RatingResult = namedtuple("RatingResult", "accounts interest_cents fee_cents txn_id")
+
+def tier_index(bounds, cents):
+    # A balance under the lowest tier (an overdrawn account) is in the first.
+    return max(bisect_right(bounds, cents) - 1, 0)
+
+def tier_indexes(bounds, column):
+    return numpy.maximum(numpy.searchsorted(bounds, column, side="right") - 1, 0)
+
+def rate_balances(balances, schedule, interest=True, fees=True):
+    # One month's interest and maintenance fee in cents for each balance.
+    # Interest is rounded half-up and only paid on a positive balance; a fee
+    # never takes a balance below zero, nor pays anything back.
+    if numpy is not None:
+        column = numpy.asarray(balances, dtype=numpy.int64)
+        accrued = numpy.zeros_like(column)
+        if interest:
+            bounds, rates = zip(*schedule.interest_tiers)
+            rate = numpy.asarray(rates, dtype=numpy.int64)[tier_indexes(bounds, column)]
+            accrued = numpy.where(column > 0, (column * rate + 60000) // 120000, 0)
+        charged = numpy.zeros_like(column)
+        if fees:
+            bounds, amounts = zip(*schedule.fee_tiers)
+            fee = numpy.asarray(amounts, dtype=numpy.int64)[tier_indexes(bounds, column)]
+            charged = numpy.maximum(0, numpy.minimum(fee, column + accrued))
+        return accrued.tolist(), charged.tolist()
+    accrued = [0] * len(balances)
+    if interest:
+        bounds, rates = zip(*schedule.interest_tiers)
+        accrued = [(cents * rates[tier_index(bounds, cents)] + 60000) // 120000 if cents > 0 else 0 for cents in balances]
+    charged = [0] * len(balances)
+    if fees:
+        bounds, amounts = zip(*schedule.fee_tiers)
+        charged = [max(0, min(amounts[tier_index(bounds, cents)], cents + extra)) for cents, extra in zip(balances, accrued)]
+    return accrued, charged
+
+def current_period():
+    return time.strftime("%Y-%m")
+
+@contextmanager
+def rating_state(storage):
+    # The state in storage.rating_path, {"rated": period, "pending":
+    # {"period", "txn_id"} or None}, locked against other runs; changes to
+    # the yielded dict are saved.
+    with open(storage.rating_path, "a+") as file:
+        fcntl.lockf(file, fcntl.LOCK_EX)
+        file.seek(0)
+        text = file.read()
+        state = json.loads(text) if text else {"rated": None, "pending": None}
+        pending = state["pending"]
+        if pending is not None:
+            # An earlier run died between its commit and marking the period done.
+            if storage.find_transaction(pending["txn_id"]):
+                state["rated"] = pending["period"]
+            state["pending"] = None
+        yield state
+        save_state(storage, state)
+
+def save_state(storage, state):
+    temp_file = storage.rating_path + ".tmp"
+    with open(temp_file, "w") as file:
+        json.dump(state, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file, storage.rating_path)
+
+def run_rating(bank, schedule=DEFAULT_SCHEDULE, interest=True, fees=True, dry_run=False, period=None):
+    # Rates every account in bank for period (default: this month). Raises
+    # ValueError for a period already rated. A ConflictError means another
+    # process changed an account during the run; nothing was written, run
+    # it again.
+    period = period or current_period()
+    time.strptime(period, "%Y-%m")  # ValueError unless YYYY-MM
+    storage = bank.storage
+    with rating_state(storage) as state:
+        if state["rated"] is not None and period <= state["rated"]:
+            raise ValueError(f"{period} is already rated (last rated period: {state['rated']}).")
+        storage.refresh()
+        # Only the balance column is read for every account; the rest of an
+        # account is fetched when it actually changes.
+        numbers, balances = [], []
+        for acc_num, cents in storage.balances():
+            numbers.append(acc_num)
+            balances.append(cents)
+        accrued, charged = rate_balances(balances, schedule, interest, fees)
+        changed = [(acc_num, cents, extra, fee) for acc_num, cents, extra, fee in zip(numbers, balances, accrued, charged)
+                   if extra or fee]
+        del numbers, balances
+        txn_id = None if dry_run or not changed else storage.next_txn_id()
+        result = RatingResult(len(changed), sum(accrued), sum(charged), txn_id)
+        if dry_run:
+            return result
+        now = int(time.time())
+        records = []
+        for acc_num, cents, extra, fee in changed:
+            acc_data = storage.get_account(acc_num)
+            if acc_data is None or acc_data["balance_cents"] != cents:
+                raise ConflictError(f"Account {acc_num} was changed by another process.")
+            record = {field: acc_data[field] for field in ACCOUNT_FIELDS}
+            record["account_number"] = acc_num
+            record["balance_cents"] += extra - fee
+            record["version"] += 1
+            record["history_start"] = acc_data["history_count"]
+            record["transaction_history"] = ([make_entry("Interest", extra, 0, now, txn_id)] if extra else []) + \
+                                            ([make_entry("Maintenance Fee", fee, fee, now, txn_id)] if fee else [])
+            records.append(record)
+        if records:
+            save_state(storage, dict(state, pending={"period": period, "txn_id": txn_id}))
+            with storage.bulk():
+                storage.write(records)
+                bank.checkpoint()  # a run is a record per account: fold it in rather than replay it on every start
+        state["rated"] = period
+    # Accounts this Bank already holds are brought up to date, as a
+    # transaction would do on their next use.
+    loaded = bank.accounts._cache
+    for record in records:
+        account = loaded.get(record["account_number"])
+        if account is not None:
+            acc_data = dict(record, history_count=record["history_start"] + len(record["transaction_history"]))
+            account.refresh(acc_data, lambda acc_num=record["account_number"]: bank.storage.get_history(acc_num))
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply monthly interest and maintenance fees to every account.")
+    parser.add_argument("--db", help="use this JSON file, .bin snapshot, SQLite database or shard directory instead of bank_data.json")
+    parser.add_argument("--no-interest", action="store_true")
+    parser.add_argument("--no-fees", action="store_true")
+    parser.add_argument("--dry-run", action="store_true", help="show the totals without writing anything")
+    parser.add_argument("--period", help="period to rate, YYYY-MM (default: this month); each is rated once")
+    args = parser.parse_args()
+    bank = Bank(open_storage(args.db), lazy=True)
+    try:
+        started = time.perf_counter()
+        result = run_rating(bank, interest=not args.no_interest, fees=not args.no_fees, dry_run=args.dry_run,
+                            period=args.period)
+    except ValueError as error:
+        print(error)
+        sys.exit(1)
+    finally:
+        bank.close()
+    print(f"{'Would change' if args.dry_run else 'Changed'} {result.accounts} accounts: "
+          f"${format_money(result.interest_cents)} interest, ${format_money(result.fee_cents)} fees "
+          f"({time.perf_counter() - started:.1f}s)")
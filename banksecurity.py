@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+
+# Password and PIN hashing, and the session cache.
+#
+# Secrets are stored as "pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>".
+# Values from before hashing are plaintext; they still verify, and the
+# engine replaces them with a hash the next time the right secret is given.
+# A successful check is remembered (under a fast hash of the stored value
+# and the secret, never the secret itself), so checking the same password or
+# PIN again - every transfer of a session - costs microseconds instead of a
+# full PBKDF2 run. Failed checks are never remembered.
+#
+# A hash costs about 50 ms of CPU; hash_secrets spreads many over threads
+# (PBKDF2 releases the GIL). Bulk loads may use fewer iterations: such a
+# hash, like a plaintext value, needs_rehash and is replaced at full
+# strength the next time the right secret is given.
+
+HASH_SCHEME = "pbkdf2_sha256"
+PBKDF2_ITERATIONS = 100000
+VERIFIED_CACHE_SIZE = 10000
+SESSION_TTL = 15 * 60  # seconds a session stays open without use
+SESSION_CAPACITY = 100000  # open sessions kept; the least recently used go first
+
+_verified = OrderedDict()
+_verified_lock = threading.Lock()
+
+
+def hash_secret(secret, iterations=PBKDF2_ITERATIONS):
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac("sha256", str(secret).encode(), salt, iterations)
+    return f"{HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+def hash_secrets(values, iterations=PBKDF2_ITERATIONS, workers=None):
+    # [hash_secret(value) for value in values], on up to workers threads
+    # (default: one per CPU).
+    values = list(values)
+    if len(values) < 2 or workers == 1:
+        return [hash_secret(value, iterations) for value in values]
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(hash_secret, values, [iterations] * len(values)))
+
+def is_hashed(stored):
+    return str(stored).startswith(HASH_SCHEME + "$")
+
+def needs_rehash(stored):
+    return not is_hashed(stored) or int(str(stored).split("$")[1]) < PBKDF2_ITERATIONS
+
+def verify_secret(stored, secret):
+    if stored is None or secret is None:
+        return False
+    stored, secret = str(stored), str(secret)
+    key = hashlib.sha256(f"{stored}\0{secret}".encode()).digest()
+    with _verified_lock:
+        if key in _verified:
+            _verified.move_to_end(key)
+            return True
+    if is_hashed(stored):
+        scheme, iterations, salt, expected = stored.split("$")
+        digest = hashlib.pbkdf2_hmac("sha256", secret.encode(), bytes.fromhex(salt), int(iterations)).hex()
+        ok = hmac.compare_digest(digest, expected)
+    else:
+        ok = hmac.compare_digest(stored.encode(), secret.encode())
+    if ok:
+        with _verified_lock:
+            _verified[key] = True
+            if len(_verified) > VERIFIED_CACHE_SIZE:
+                _verified.popitem(last=False)
+    return ok
+
+
+class SessionCache:
+    # Session tokens of logged-in accounts. A session expires ttl seconds
+    # after its last use; past capacity the least recently used one is
+    # dropped. Safe to share between threads.
+    def __init__(self, ttl=SESSION_TTL, capacity=SESSION_CAPACITY, clock=time.monotonic):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.clock = clock
+        self._sessions = OrderedDict()  # token -> [account number, expiry]
+        self._lock = threading.Lock()
+
+    def open(self, account_number):
+        token = secrets.token_urlsafe(24)
+        with self._lock:
+            self._sessions[token] = [account_number, self.clock() + self.ttl]
+            while len(self._sessions) > self.capacity:
+                self._sessions.popitem(last=False)
+        return token
+
+    def get(self, token):
+        # The session's account number, or None once it is closed or expired.
+        now = self.clock()
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            if session[1] <= now:
+                del self._sessions[token]
+                return None
+            session[1] = now + self.ttl
+            self._sessions.move_to_end(token)
+            return session[0]
+
+    def close(self, token):
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,193 @@
+from bankcore import Bank, BankError, SessionError
+from banksecurity import hash_secrets, verify_secret
+from bankshard import ShardedStorage
+from bankstorage import JsonStorage, open_storage
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import bankmetrics
+import json
+import os
+
+# Newline-delimited JSON over TCP. Each request is an object with an "op"
+# and its arguments; each response is {"ok": true, "result": ...} or
+# {"ok": false, "error": <error class>, "message": ...}. Requests may carry
+# an "id", which is echoed back. Amounts in requests are dollars; balances,
+# fees and history amounts in responses are whole cents.
+#
+#   {"op": "create_account", "name", "username", "password", "pin", "initial_balance"}
+#   {"op": "login", "username", "password"}          -> {"session", "account_number"}
+#   {"op": "logout", "session"}
+#   {"op": "deposit" | "withdraw", "session", "amount"}
+#   {"op": "transfer", "session", "to", "amount", "pin"}
+#   {"op": "balance", "session"}
+#   {"op": "history", "session", ["limit", "before", "since", "until"]}
+#                                                    -> {"transaction_history", "next"}
+#       newest first; pass "next" back as "before" for the following page
+#   {"op": "metrics", ["format": "json" | "prometheus"]}  -> see bankmetrics
+#       only collected when the server runs with --metrics
+#
+# The engine is not thread-safe, so every operation on it runs on one
+# worker thread, one at a time, in the order requests reach it; that is
+# also what keeps two requests for one account from interleaving, so there
+# are no per-account locks on top. What keeps that thread short is that the
+# slow part, PBKDF2 (~50 ms a hash), runs on a separate pool beforehand:
+# the hashes of a new account, the password check of a login and the PIN
+# check of a session's first transfer (see banksecurity's cache of
+# successful checks). A wrong PIN is still checked again on the engine.
+
+HOST = "127.0.0.1"
+PORT = 8765
+HASH_WORKERS = os.cpu_count() or 1
+
+
+class BankServer:
+    def __init__(self, storage_factory=JsonStorage):
+        self.storage_factory = storage_factory
+        # The engine and its storage run on one worker thread, so file and
+        # database writes never block the event loop; hashing runs on hasher.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.hasher = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+        self.bank = None
+        self.server = None
+
+    async def start(self, host=HOST, port=PORT):
+        self.bank = await self.call(lambda: Bank(self.storage_factory(), lazy=True))
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.bank is not None:
+            await self.call(self.bank.close)
+        self.executor.shutdown()
+        self.hasher.shutdown()
+
+    async def call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def hash(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.hasher, func, *args)
+
+    async def handle_client(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    response = await self.dispatch(request)
+                except json.JSONDecodeError:
+                    request, response = {}, {"ok": False, "error": "BadRequest", "message": "Request is not valid JSON."}
+                if isinstance(request, dict) and "id" in request:
+                    response["id"] = request["id"]
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, request):
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "BadRequest", "message": "Request is not a JSON object."}
+        handler = getattr(self, "op_" + str(request.get("op")), None)
+        if handler is None:
+            return {"ok": False, "error": "BadRequest", "message": f"Unknown operation: {request.get('op')}"}
+        try:
+            with bankmetrics.timer("server." + request["op"]):
+                return {"ok": True, "result": await handler(request)}
+        except BankError as error:
+            return {"ok": False, "error": type(error).__name__, "message": str(error)}
+        except (KeyError, TypeError, ValueError) as error:
+            return {"ok": False, "error": "BadRequest", "message": f"Bad or missing argument: {error}"}
+
+    def session_account(self, request):
+        # Sessions live in the bank's SessionCache (thread-safe), so this
+        # needs no trip to the engine thread.
+        return self.bank.session_account(request["session"])
+
+    async def op_create_account(self, request):
+        initial_balance = float(request["initial_balance"])
+        password, pin = await self.hash(hash_secrets, [request["password"], request["pin"]])
+        account = await self.call(lambda: self.bank.create_account(
+            request["name"], request["username"], password, pin, initial_balance, hashed=True))
+        return {"account_number": account.get_account_number()}
+
+    async def op_login(self, request):
+        user = await self.call(self.bank.find_user, request["username"])
+        if user is None:
+            raise SessionError("Username not found.")
+        checked = (user[0], await self.hash(verify_secret, user[0], request["password"]))
+        session, account = await self.call(self.bank.open_session, request["username"], request["password"],
+                                           checked)
+        return {"session": session, "account_number": account.get_account_number()}
+
+    async def op_logout(self, request):
+        self.bank.close_session(request["session"])
+        return {}
+
+    async def op_deposit(self, request):
+        account_number = self.session_account(request)
+        receipt = await self.call(self.bank.deposit, account_number, float(request["amount"]))
+        return receipt._asdict()
+
+    async def op_withdraw(self, request):
+        account_number = self.session_account(request)
+        receipt = await self.call(self.bank.withdraw, account_number, float(request["amount"]))
+        return receipt._asdict()
+
+    async def op_transfer(self, request):
+        account_number = self.session_account(request)
+        recipient_number = int(request["to"])
+        account = await self.call(self.bank.require_account, account_number)
+        await self.hash(verify_secret, account.pin, request["pin"])  # a right PIN is then a cache hit
+        receipt = await self.call(self.bank.transfer, account_number, recipient_number,
+                                  float(request["amount"]), request["pin"])
+        return receipt._asdict()
+
+    async def op_balance(self, request):
+        account_number = self.session_account(request)
+        return {"balance": await self.call(self.bank.balance, account_number)}
+
+    async def op_history(self, request):
+        account_number = self.session_account(request)
+        page, cursor = await self.call(lambda: self.bank.history_page(
+            account_number, int(request.get("limit", 50)), request.get("before"),
+            since=request.get("since"), until=request.get("until")))
+        return {"transaction_history": [entry for seq, entry in page], "next": cursor}
+
+    async def op_metrics(self, request):
+        if request.get("format", "json") == "prometheus":
+            return bankmetrics.dump_prometheus()
+        return bankmetrics.snapshot()
+
+
+
+async def serve(host, port, storage_factory):
+    bank_server = BankServer(storage_factory)
+    server = await bank_server.start(host, port)
+    print(f"Serving on {host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await bank_server.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the bank over TCP (newline-delimited JSON).")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--db", help="use this JSON file, .bin snapshot, SQLite database or shard directory instead of bank_data.json")
+    parser.add_argument("--shards", help="use this shard directory (see bankshard.py) instead of bank_data.json")
+    parser.add_argument("--metrics", action="store_true", help="collect timings and counters for the metrics op")
+    args = parser.parse_args()
+    bankmetrics.enable(args.metrics)
+    if args.shards:
+        storage_factory = lambda: ShardedStorage(args.shards)
+    else:
+        storage_factory = lambda: open_storage(args.db)
+    try:
+        asyncio.run(serve(args.host, args.port, storage_factory))
+    except KeyboardInterrupt:
+        pass
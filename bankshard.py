@@ -0,0 +1,302 @@
+from bankfeed import EventFeed
+from bankstorage import ACCOUNT_SORTS, STAT_NAMES, ConflictError, JsonStorage, bump_counter, snapshot_records
+from contextlib import ExitStack, contextmanager, nullcontext
+import argparse
+import fcntl
+import heapq
+import itertools
+import json
+import os
+import sys
+
+SHARD_DIR = "bank_shards"
+DEFAULT_SHARDS = 16
+
+def shard_path(directory, index):
+    return os.path.join(directory, f"shard-{index:03d}.json")
+
+def shard_journal_path(directory, index):
+    return os.path.join(directory, f"shard-{index:03d}.jsonl")
+
+
+class ShardedStorage:
+    # Accounts spread over several JsonStorage files by account number
+    # (number % shards), each with its own snapshot, journal and lock file,
+    # loaded on first use. A deposit touches one shard; a transfer between
+    # shards commits to both through commits.jsonl:
+    #   1. take both shards' write locks (in shard order) and check both
+    #   2. append every record to commits.jsonl and fsync - the commit point
+    #   3. append each shard's records to its journal and fsync
+    # If a writer dies between 2 and 3, the next process to lock one of those
+    # shards finds the line in commits.jsonl and redoes the missing part (a
+    # record is missing when the account's version is still below it).
+    # Usernames are not partitioned: writes that create accounts also take
+    # users.lock, so only one at a time checks a username is free everywhere.
+    def __init__(self, directory=SHARD_DIR, shards=None, journal=True, fsync_policy="group"):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        config_path = os.path.join(directory, "shards.json")
+        if os.path.exists(config_path):
+            with open(config_path) as file:
+                count = json.load(file)["shards"]
+            if shards is not None and shards != count:
+                raise ValueError(f"{directory} has {count} shards, not {shards}; use the reshard tool.")
+        else:
+            count = shards or DEFAULT_SHARDS
+            with open(config_path, "w") as file:
+                json.dump({"shards": count}, file)
+        self.txn_path = os.path.join(directory, "txn")
+        self.allocator_path = os.path.join(directory, "alloc")
+        self.rating_path = os.path.join(directory, "rating")
+        self.feed = EventFeed(os.path.join(directory, "feed"))  # one feed for every shard
+        self.shards = [JsonStorage(shard_path(directory, i), shard_journal_path(directory, i), journal, fsync_policy, self.txn_path,
+                                   self.feed) for i in range(count)]
+        self.commit_path = os.path.join(directory, "commits.jsonl")
+        self._commits_seen = {}  # shard index -> (commit log inode, bytes already redone)
+        self._user_lock_file = None
+
+    def shard_index(self, account_number):
+        return int(account_number) % len(self.shards)
+
+    def shard(self, account_number):
+        return self.shards[self.shard_index(account_number)]
+
+    def load(self):
+        data = {"accounts": {}, "users": {}}
+        with self._write_locks(range(len(self.shards))):
+            for shard in self.shards:
+                shard_data = shard._image()
+                data["accounts"].update(shard_data["accounts"])
+                data["users"].update(shard_data["users"])
+        return data
+
+    def refresh(self):
+        for shard in self.shards:
+            if shard.data is not None:
+                shard.refresh()
+
+    @contextmanager
+    def lock(self, account_numbers=()):
+        groups = self._group(account_numbers)
+        with ExitStack() as stack:
+            for index in sorted(groups):
+                stack.enter_context(self.shards[index].lock(groups[index]))
+            with self._write_locks(groups):
+                pass
+            yield
+
+    def get_account(self, account_number):
+        return self.shard(account_number).get_account(account_number)
+
+    def get_history(self, account_number):
+        return self.shard(account_number).get_history(account_number)
+
+    def iter_history(self, account_number, *args, **kwargs):
+        return self.shard(account_number).iter_history(account_number, *args, **kwargs)
+
+    def find_transaction(self, txn_id):
+        return [leg for shard in self.shards for leg in shard.find_transaction(txn_id)]
+
+    def next_txn_id(self, count=1):
+        return bump_counter(self.txn_path, max(shard._last_txn_id for shard in self.shards), count)
+
+    def find_user(self, username):
+        # Usernames are not partitioned, so an unknown one is looked for in
+        # every shard (each lookup is a dict hit once the shard is loaded).
+        for shard in self.shards:
+            user = shard.find_user(username)
+            if user is not None:
+                return user
+        return None
+
+    def account_numbers(self):
+        return [acc_num for shard in self.shards for acc_num in shard.account_numbers()]
+
+    def count(self):
+        return sum(shard.count() for shard in self.shards)
+
+    def iter_accounts(self, sort=None, descending=False, after=None, locked=None, min_balance=None, max_balance=None):
+        streams = [shard.iter_accounts(sort, descending, after, locked, min_balance, max_balance) for shard in self.shards]
+        if sort is None:
+            return itertools.chain.from_iterable(streams)
+        # Each shard is already in order, so a merge keeps it that way.
+        column = ACCOUNT_SORTS[sort]
+        return heapq.merge(*streams, key=lambda acc_data: (acc_data[column], acc_data["account_number"]), reverse=descending)
+
+    def balances(self):
+        return itertools.chain.from_iterable(shard.balances() for shard in self.shards)
+
+    def stats(self):
+        totals = dict.fromkeys(STAT_NAMES, 0)
+        for shard in self.shards:
+            for name, value in shard.stats().items():
+                totals[name] += value
+        return totals
+
+    def write(self, records, check=True):
+        records = list(records)
+        groups = {}
+        for record in records:
+            groups.setdefault(self.shard_index(record["account_number"]), []).append(record)
+        new = [record for record in records
+               if check and self.shard(record["account_number"]).get_account(record["account_number"]) is None]
+        with self._user_lock() if new else nullcontext():
+            if new:
+                self._check_usernames(new)
+            with self._write_locks(groups):
+                if check:
+                    for index, shard_records in groups.items():
+                        self.shards[index]._check(shard_records)
+                if len(groups) > 1:
+                    self._append_commit(records)
+                for index, shard_records in groups.items():
+                    shard = self.shards[index]
+                    shard._commit(shard_records, publish=check)
+                    if len(groups) > 1 and shard.journal is not None:
+                        shard.journal.sync()
+        for index in groups:
+            shard = self.shards[index]
+            if shard._checkpoint_due and shard._may_checkpoint():
+                shard.checkpoint()
+
+    def checkpoint(self):
+        # With every shard's write lock held no commit is half done, so the
+        # commit log can start over.
+        with self._write_locks(range(len(self.shards))):
+            with open(self.commit_path + ".tmp", "w"):
+                pass
+            os.replace(self.commit_path + ".tmp", self.commit_path)
+        for shard in self.shards:
+            shard.checkpoint()
+
+    @contextmanager
+    def bulk(self):
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.bulk())
+            yield
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        if self._user_lock_file is not None:
+            self._user_lock_file.close()
+            self._user_lock_file = None
+
+    @contextmanager
+    def _user_lock(self):
+        if self._user_lock_file is None:
+            self._user_lock_file = open(os.path.join(self.directory, "users.lock"), "a")
+        fcntl.lockf(self._user_lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._user_lock_file, fcntl.LOCK_UN)
+
+    def _check_usernames(self, records):
+        # The usernames of new accounts must be free in every shard. Callers
+        # hold users.lock, so no other process can take one of them before
+        # these records are committed.
+        self.refresh()
+        for record in records:
+            user = self.find_user(record["username"])
+            if user is not None and int(user[1]) != int(record["account_number"]):
+                raise ConflictError(f"Username {record['username']} is already taken.")
+
+    def _group(self, account_numbers):
+        groups = {}
+        for acc_num in account_numbers:
+            groups.setdefault(self.shard_index(acc_num), []).append(acc_num)
+        return groups
+
+    @contextmanager
+    def _write_locks(self, indexes):
+        # Write locks of the given shards, always taken in shard order, with
+        # each shard refreshed and any unfinished cross-shard commit redone.
+        indexes = sorted(indexes)
+        with ExitStack() as stack:
+            for index in indexes:
+                stack.enter_context(self.shards[index]._write_lock())
+            for index in indexes:
+                self.shards[index]._refresh()
+            self._recover(indexes)
+            yield
+
+    def _append_commit(self, records):
+        # The leading newline ends any line a crashed writer left torn.
+        with open(self.commit_path, "a") as file:
+            file.write("\n" + json.dumps(records, separators=(",", ":")) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _recover(self, indexes):
+        try:
+            inode = os.stat(self.commit_path).st_ino
+        except FileNotFoundError:
+            return
+        seen = {index: self._commits_seen.get(index, (inode, 0)) for index in indexes}
+        seen = {index: offset if seen_inode == inode else 0 for index, (seen_inode, offset) in seen.items()}
+        if not seen:
+            return
+        offset = min(seen.values())
+        with open(self.commit_path, "rb") as file:
+            file.seek(offset)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break  # still being written, or torn
+                line_start = offset
+                offset += len(line)
+                try:
+                    records = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                for record in records:
+                    index = self.shard_index(record["account_number"])
+                    if index not in seen or line_start < seen[index]:
+                        continue
+                    shard = self.shards[index]
+                    current = shard.get_account(record["account_number"])
+                    if (current["version"] if current else 0) < record["version"]:
+                        shard._commit([record])
+        for index in seen:
+            self._commits_seen[index] = (inode, offset)
+
+
+def reshard(source, target_directory, shards, journal_path=None):
+    # Copies a bank_data.json (with its journal and archive) or a shard
+    # directory into a new shard directory with the given number of shards.
+    if os.path.isdir(source):
+        storage = ShardedStorage(source)
+        data = {"accounts": {}, "users": {}}
+        for shard in storage.shards:
+            shard_data = shard.load_with_archive()
+            data["accounts"].update(shard_data["accounts"])
+    else:
+        storage = JsonStorage(source, journal_path)
+        data = storage.load_with_archive()
+    storage.close()
+    if os.path.exists(os.path.join(target_directory, "shards.json")):
+        raise ValueError(f"{target_directory} already holds a sharded bank.")
+    target = ShardedStorage(target_directory, shards)
+    groups = {}
+    for record in snapshot_records(data):
+        groups.setdefault(target.shard_index(record["account_number"]), []).append(record)
+    for index, records in groups.items():
+        target.shards[index].write(records, check=False)
+    target.checkpoint()
+    target.close()
+    return len(data["accounts"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split a bank into shard files by account number.")
+    parser.add_argument("source", help="bank_data.json or an existing shard directory")
+    parser.add_argument("target", help="new shard directory")
+    parser.add_argument("--shards", type=int, default=DEFAULT_SHARDS)
+    parser.add_argument("--journal", help="journal of a bank_data.json source (default: <source>.jsonl)")
+    args = parser.parse_args()
+    try:
+        count = reshard(args.source, args.target, args.shards, args.journal)
+    except ValueError as error:
+        print(error)
+        sys.exit(1)
+    print(f"Copied {count} accounts into {args.shards} shards in {args.target}.")
@@ -0,0 +1,369 @@
+from bankmetrics import count, timed
+from bankstorage import ACCOUNT_FIELDS, ARCHIVED, BALANCE, HISTORY, JsonStorage, LOCKED, VERSION, dict_from_row, row_from_dict
+import argparse
+import heapq
+import io
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import zlib
+
+# Binary snapshots for JsonStorage: a path ending in ".bin" is written in
+# this format instead of JSON. The file is memory-mapped, not parsed, so
+# opening a bank reads only the header; an account is decoded the first
+# time it is asked for, and admin totals and listings read the fixed-width
+# table without decoding anybody.
+#
+# Layout, little-endian:
+#   header  MAGIC, the account count and the offset of each section
+#   table   one RECORD per account, in account number order (binary search)
+#   index   open-addressing hash table on crc32(username); each slot is the
+#           table position + 1, or 0 when empty
+#   blob    per account a JSON array [name, username, password, pin, history],
+#           each entry's kind replaced by its code in the meta's "kinds"
+#   meta    JSON: totals, locked account numbers, last txn id, the kinds,
+#           other snapshot keys
+
+MAGIC = b"BANKSNP3"  # earlier versions held an opening balance and kinds as text
+# magic, count, meta offset, meta length, table offset, index offset, index slots, blob offset
+HEADER = struct.Struct("<8sQQQQQQQ")
+# account number, balance, blob offset, blob length, version, history
+# archived, username hash, locked, login attempts, pin attempts
+RECORD = struct.Struct("<qqQIIIIBBB5x")
+NUMBER = struct.Struct("<q")
+SLOT = struct.Struct("<I")
+CHUNK = 4096  # table records unpacked at a time by full scans
+BLOB_ENCODER = json.JSONEncoder(separators=(",", ":"))
+LOGIN_ATTEMPTS = ACCOUNT_FIELDS.index("login_attempts")
+PIN_ATTEMPTS = ACCOUNT_FIELDS.index("pin_attempts")
+
+def user_hash(username):
+    return zlib.crc32(str(username).encode())
+
+
+class Snapshot:
+    # A read-only view of one snapshot file, or of an image of one held in
+    # memory (see compact).
+    def __init__(self, path, image=None):
+        if image is None:
+            with open(path, "rb") as file:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = image
+        magic, self.count, meta_offset, meta_length, self.table, self.index, self.slots, self.blob = \
+            HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a bank snapshot.")
+        self.meta = json.loads(self.map[meta_offset:meta_offset + meta_length])
+        self.kinds = [sys.intern(kind) for kind in self.meta.get("kinds", [])]
+
+    def record(self, position):
+        return RECORD.unpack_from(self.map, self.table + position * RECORD.size)
+
+    def records(self):
+        for start in range(0, self.count, CHUNK):
+            stop = min(start + CHUNK, self.count)
+            yield from RECORD.iter_unpack(self.map[self.table + start * RECORD.size:self.table + stop * RECORD.size])
+
+    def find(self, account_number):
+        # Table position of the account, or None.
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            number = NUMBER.unpack_from(self.map, self.table + middle * RECORD.size)[0]
+            if number < account_number:
+                low = middle + 1
+            elif number > account_number:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def blob_bytes(self, record):
+        start = self.blob + record[2]
+        return self.map[start:start + record[3]]
+
+    def row(self, position):
+        return self.decode(self.record(position))
+
+    def decode(self, record):
+        count("snapshot.decoded_rows")
+        return row_from_dict(self.account_data(record))
+
+    def account_data(self, record):
+        # The account as dict_from_row gives it, its entries left as lists.
+        name, username, password, pin, history = json.loads(self.blob_bytes(record))
+        kinds = self.kinds
+        history = [[kinds[entry[0]], *entry[1:]] for entry in history]
+        acc_data = {"name": name, "username": username, "password": password, "pin": pin, "balance_cents": record[1],
+                    "locked": bool(record[7]), "login_attempts": record[8], "pin_attempts": record[9],
+                    "version": record[4], "account_number": record[0], "transaction_history": history}
+        if record[5]:
+            acc_data["history_archived"] = record[5]
+        return acc_data
+
+    def find_user(self, username):
+        # [password, account number] for the username, or None.
+        wanted = user_hash(username)
+        mask = self.slots - 1
+        slot = wanted & mask
+        while True:
+            position = SLOT.unpack_from(self.map, self.index + slot * SLOT.size)[0]
+            if not position:
+                return None
+            record = self.record(position - 1)
+            if record[6] == wanted:
+                name, found, password, pin, history = json.loads(self.blob_bytes(record))
+                if found == username:
+                    return [password, record[0]]
+            slot = (slot + 1) & mask
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+
+
+class SnapshotAccounts:
+    # data["accounts"] of a binary snapshot: account number (str) -> row.
+    # A row looked up by key is decoded and kept, so changes made to it
+    # stick; items() and values() only read, and decode the rows nobody
+    # looked up without keeping them. Accounts added since the snapshot
+    # exist only here until the next one is written.
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+        self.rows = {}
+        self.added = set()
+
+    def _in_snapshot(self, key):
+        return self.snapshot is not None and self.snapshot.find(int(key)) is not None
+
+    def get(self, key, default=None):
+        row = self.peek(key)
+        if row is None:
+            return default
+        self.rows[key] = row
+        return row
+
+    def peek(self, key):
+        # The row, or None, without keeping it when it had to be decoded.
+        row = self.rows.get(key)
+        if row is None and self.snapshot is not None:
+            position = self.snapshot.find(int(key))
+            if position is not None:
+                row = self.snapshot.row(position)
+        return row
+
+    def __getitem__(self, key):
+        row = self.get(key)
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def __setitem__(self, key, row):
+        if key not in self.rows and not self._in_snapshot(key):
+            self.added.add(key)
+        self.rows[key] = row
+
+    def __contains__(self, key):
+        return key in self.rows or self._in_snapshot(key)
+
+    def __len__(self):
+        return (self.snapshot.count if self.snapshot is not None else 0) + len(self.added)
+
+    def __iter__(self):
+        if self.snapshot is not None:
+            for record in self.snapshot.records():
+                yield str(record[0])
+        yield from list(self.added)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        if self.snapshot is not None:
+            for record in self.snapshot.records():
+                key = str(record[0])
+                row = self.rows.get(key)
+                yield key, row if row is not None else self.snapshot.decode(record)
+        for key in list(self.added):
+            yield key, self.rows[key]
+
+    def values(self):
+        for key, row in self.items():
+            yield row
+
+    def account_dicts(self):
+        # (key, dict_from_row dict) of every account; the rows nobody
+        # decoded are not built at all, so writing a bank out stays cheap.
+        if self.snapshot is not None:
+            for record in self.snapshot.records():
+                key = str(record[0])
+                row = self.rows.get(key)
+                yield key, self.snapshot.account_data(record) if row is None else dict_from_row(key, row)
+        for key in list(self.added):
+            yield key, dict_from_row(key, self.rows[key])
+
+    def balances(self):
+        # (account number, balance) of every account, from the table for
+        # the rows nobody has decoded.
+        if self.snapshot is not None:
+            for record in self.snapshot.records():
+                row = self.rows.get(str(record[0]))
+                yield record[0], record[1] if row is None else row[BALANCE]
+        for key in list(self.added):
+            yield int(key), self.rows[key][BALANCE]
+
+    def sources(self):
+        # (account number, table record, row) in account number order; row
+        # is None for accounts that are unchanged since the snapshot.
+        base = ()
+        if self.snapshot is not None:
+            base = ((record[0], record, self.rows.get(str(record[0]))) for record in self.snapshot.records())
+        added = sorted((int(key), None, self.rows[key]) for key in self.added)
+        return heapq.merge(base, added, key=lambda source: source[0])
+
+
+class SnapshotUsers:
+    # data["users"] of a binary snapshot: username -> [password, account
+    # number], looked up in the snapshot's index under the changes since.
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+        self.changed = {}
+
+    def get(self, username, default=None):
+        user = self.changed.get(username)
+        if user is None and self.snapshot is not None:
+            user = self.snapshot.find_user(username)
+        return default if user is None else user
+
+    def __getitem__(self, username):
+        user = self.get(username)
+        if user is None:
+            raise KeyError(username)
+        return user
+
+    def __setitem__(self, username, user):
+        self.changed[username] = user
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+
+@timed("storage.load_snapshot")
+def load_snapshot(path):
+    # Returns (data, meta); a missing file is an empty bank.
+    try:
+        snapshot = Snapshot(path)
+    except FileNotFoundError:
+        return {"accounts": SnapshotAccounts(), "users": SnapshotUsers()}, {}
+    data = dict(snapshot.meta.get("data", {}), accounts=SnapshotAccounts(snapshot), users=SnapshotUsers(snapshot))
+    return data, snapshot.meta
+
+def write_snapshot(file, data, meta):
+    # Writes the layout above to file, which must be seekable; returns its
+    # size. Unchanged accounts are copied from the current snapshot byte for
+    # byte; only decoded and new rows are encoded again. meta gets the keys
+    # of data other than accounts and users added as "data".
+    accounts = data["accounts"]
+    if isinstance(accounts, SnapshotAccounts):
+        sources = accounts.sources()
+    else:
+        sources = ((int(key), None, accounts[key]) for key in sorted(accounts, key=int))
+    total = len(accounts)
+    slots = 1
+    while slots < 2 * total:
+        slots *= 2
+    # Copied blobs keep their codes, so the kinds of the current snapshot
+    # come first and new ones are added after them.
+    codes = {}
+    if isinstance(accounts, SnapshotAccounts) and accounts.snapshot is not None:
+        codes = {kind: code for code, kind in enumerate(accounts.snapshot.kinds)}
+    table_offset = HEADER.size
+    index_offset = table_offset + total * RECORD.size
+    blob_offset = index_offset + slots * SLOT.size
+    table = bytearray(total * RECORD.size)
+    index = bytearray(slots * SLOT.size)
+    file.seek(blob_offset)
+    written = 0
+    for position, (acc_num, record, row) in enumerate(sources):
+        if row is None:
+            blob = accounts.snapshot.blob_bytes(record)
+            hashed = record[6]
+            RECORD.pack_into(table, position * RECORD.size, acc_num, record[1], written, len(blob), *record[4:])
+        else:
+            history = [[codes.setdefault(entry[0], len(codes)), *entry[1:]] for entry in row[HISTORY]]
+            blob = BLOB_ENCODER.encode(row[:4] + [history]).encode()
+            hashed = user_hash(row[1])
+            RECORD.pack_into(table, position * RECORD.size, acc_num, row[BALANCE], written, len(blob), row[VERSION],
+                             row[ARCHIVED], hashed, bool(row[LOCKED]), row[LOGIN_ATTEMPTS], row[PIN_ATTEMPTS])
+        file.write(blob)
+        written += len(blob)
+        slot = hashed & (slots - 1)
+        while SLOT.unpack_from(index, slot * SLOT.size)[0]:
+            slot = (slot + 1) & (slots - 1)
+        SLOT.pack_into(index, slot * SLOT.size, position + 1)
+    meta = dict(meta, kinds=list(codes),
+                data={key: value for key, value in data.items() if key not in ("accounts", "users")})
+    meta_bytes = json.dumps(meta).encode()
+    file.write(meta_bytes)
+    file.seek(0)
+    file.write(HEADER.pack(MAGIC, total, blob_offset + written, len(meta_bytes), table_offset, index_offset, slots,
+                           blob_offset))
+    file.write(table)
+    file.write(index)
+    return blob_offset + written + len(meta_bytes)
+
+@timed("storage.save_snapshot")
+def save_snapshot(data, path, meta):
+    temp_file = path + ".tmp"
+    with open(temp_file, "wb") as file:
+        size = write_snapshot(file, data, meta)
+        file.flush()
+        count("storage.snapshot_bytes", size)
+        os.fsync(file.fileno())
+    os.replace(temp_file, path)
+
+@timed("storage.compact")
+def compact(data):
+    # (accounts, users) for data, backed by a snapshot image in memory
+    # instead of a row per account: a JSON bank is held this way, as a few
+    # hundred bytes per account, and only the rows in use are decoded.
+    buffer = io.BytesIO()
+    size = write_snapshot(buffer, {"accounts": data["accounts"]}, {})
+    count("storage.compact_bytes", size)
+    snapshot = Snapshot(None, buffer.getvalue())
+    return SnapshotAccounts(snapshot), SnapshotUsers(snapshot)
+
+def convert(source, target, journal_path=None):
+    # Copies a JSON bank (with its journal) into a binary snapshot at target,
+    # along with its history archive and account number allocator state.
+    # Returns the number of accounts.
+    if os.path.exists(target):
+        raise ValueError(f"{target} already exists.")
+    storage = JsonStorage(source, journal_path)
+    try:
+        storage.write_binary(target)
+        for suffix in (".archive", ".alloc", ".txn"):
+            if os.path.isdir(source + suffix):
+                shutil.copytree(source + suffix, target + suffix)
+            elif os.path.exists(source + suffix):
+                shutil.copy(source + suffix, target + suffix)
+        return storage.count()
+    finally:
+        storage.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert bank_data.json into a binary snapshot.")
+    parser.add_argument("source", nargs="?", default="bank_data.json")
+    parser.add_argument("target", nargs="?", default="bank_data.bin")
+    parser.add_argument("--journal", help="journal of the source (default: <source>.jsonl)")
+    args = parser.parse_args()
+    try:
+        total = convert(args.source, args.target, args.journal)
+    except ValueError as error:
+        print(error)
+    else:
+        print(f"Wrote {total} accounts to {args.target}; open it with its own journal, {args.target}.jsonl.")
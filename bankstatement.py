@@ -0,0 +1,70 @@
+from bankcore import Bank
+from bankmoney import format_money
+from bankstorage import open_storage
+from datetime import datetime
+import argparse
+import csv
+import json
+
+# Statement export. Rows are written as they come out of Bank.statement,
+# so a long history is never held in memory or formatted all at once.
+
+FORMATS = ("csv", "jsonl")
+COLUMNS = ["seq", "txn_id", "date", "type", "amount", "fee", "counterparty"]
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S") if timestamp else ""
+
+def parse_date(text):
+    # "YYYY-MM-DD" (local midnight) to a Unix timestamp, or None for "".
+    return int(datetime.strptime(text, "%Y-%m-%d").timestamp()) if text else None
+
+def statement_rows(bank, account_number, **filters):
+    for seq, entry in bank.statement(account_number, **filters):
+        yield [seq, entry.txn_id, format_time(entry.timestamp), entry.kind, format_money(entry.amount),
+               format_money(entry.fee), entry.counterparty]
+
+def write_csv(rows, file):
+    writer = csv.writer(file)
+    writer.writerow(COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+def write_jsonl(rows, file):
+    count = 0
+    for row in rows:
+        file.write(json.dumps(dict(zip(COLUMNS, row))) + "\n")
+        count += 1
+    return count
+
+def export_statement(bank, account_number, path, fmt=None, **filters):
+    # Returns the number of rows written. The format defaults to the file extension.
+    fmt = fmt or ("jsonl" if path.endswith(".jsonl") else "csv")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown statement format: {fmt}")
+    with open(path, "w", newline="") as file:
+        rows = statement_rows(bank, account_number, **filters)
+        return write_csv(rows, file) if fmt == "csv" else write_jsonl(rows, file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export an account statement as CSV or JSONL.")
+    parser.add_argument("account_number", type=int)
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--since", help="first day to include (YYYY-MM-DD)")
+    parser.add_argument("--until", help="first day to leave out (YYYY-MM-DD)")
+    parser.add_argument("--type", action="append", dest="kinds", help="only entries whose type starts with this")
+    parser.add_argument("--counterparty", type=int, help="only transfer legs with this account")
+    parser.add_argument("--db", help="read this JSON file, .bin snapshot, SQLite database or shard directory instead of bank_data.json")
+    args = parser.parse_args()
+    bank = Bank(open_storage(args.db), lazy=True)
+    try:
+        count = export_statement(bank, args.account_number, args.path, args.format,
+                                 since=parse_date(args.since), until=parse_date(args.until), kinds=args.kinds,
+                                 counterparty=args.counterparty)
+    finally:
+        bank.close()
+    print(f"Wrote {count} entries to {args.path}")
@@ -0,0 +1,1017 @@
+from bankarchive import HistoryArchive
+from bankfeed import EventFeed
+from bankjournal import Journal
+from bankmetrics import count, timed, timer
+from bankmoney import upgrade_account_data
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+import fcntl
+import json
+import os
+import sqlite3
+import sys
+import time
+
+DATA_FILE = "bank_data.json"
+JOURNAL_FILE = DATA_FILE + ".jsonl"  # a bank's journal is always <data file>.jsonl, see journal_path_for
+LEGACY_JOURNAL_FILE = "bank_journal.jsonl"
+DB_FILE = "bank_data.db"
+BINARY_SUFFIX = ".bin"  # JsonStorage paths ending in this hold a binary snapshot, see banksnapshot
+CHECKPOINT_EVERY = 1000  # journal records before folding them into the snapshot
+ARCHIVE_AFTER_DAYS = 90  # history older than this moves out of the snapshot...
+COMPACT_EVERY = 24 * 3600  # ...at the first checkpoint this many seconds after the last move
+
+ACCOUNT_FIELDS = ("name", "username", "password", "pin", "balance_cents", "locked", "login_attempts", "pin_attempts", "version")
+FIELD_DEFAULTS = {"locked": False, "login_attempts": 0, "pin_attempts": 0, "version": 0}
+# JSON rows are the ACCOUNT_FIELDS values, the hot history, the number of
+# entries moved to the archive before it and the balance they added up to.
+HISTORY = len(ACCOUNT_FIELDS)
+ARCHIVED = HISTORY + 1
+VERSION = ACCOUNT_FIELDS.index("version")
+BALANCE = ACCOUNT_FIELDS.index("balance_cents")
+LOCKED = ACCOUNT_FIELDS.index("locked")
+ENTRY_COLUMNS = "type, amount_cents, fee_cents, timestamp, txn_id, counterparty"
+
+# History entries are (kind, amount_cents, fee_cents, timestamp, txn_id,
+# counterparty) tuples. The same few kind labels repeat across millions of
+# entries, so they are interned and every entry points at one shared string.
+# On disk they are plain JSON arrays. Entries from older files have None in
+# the fields that did not exist yet.
+#
+# txn_id is global and increasing; every leg of one operation shares it (a
+# transfer is the sender's debit and fee plus the recipient's credit).
+# counterparty is the other account's number on transfer legs.
+Transaction = namedtuple("Transaction", "kind amount fee timestamp txn_id counterparty", defaults=(None, None, None))
+
+def make_entry(kind, amount, fee=0, timestamp=None, txn_id=None, counterparty=None):
+    return Transaction(sys.intern(kind), amount, fee, timestamp, txn_id, counterparty)
+
+def compact_entry(entry):
+    return entry if type(entry) is Transaction else Transaction(sys.intern(entry[0]), *entry[1:6])
+
+def entry_time(entry):
+    return entry.timestamp or 0
+
+# Admin totals, kept up to date on every write instead of being recounted.
+# balance_bucket_N counts the accounts whose balance is below bound N of
+# BALANCE_BUCKETS (in cents) but not below bound N - 1; the last bucket has
+# no upper bound.
+BALANCE_BUCKETS = (1000, 10000, 100000, 1000000, 10000000)
+STAT_NAMES = ("accounts", "locked_accounts", "balance_cents") + tuple(
+    f"balance_bucket_{i}" for i in range(len(BALANCE_BUCKETS) + 1))
+# Orders the account listing can be read in, and the field each sorts by.
+ACCOUNT_SORTS = {"account_number": "account_number", "balance": "balance_cents"}
+
+def count_account(stats, balance_cents, locked, sign=1):
+    # Adds one account to the totals in stats, or takes it away with sign=-1.
+    stats["accounts"] += sign
+    stats["locked_accounts"] += sign if locked else 0
+    stats["balance_cents"] += sign * balance_cents
+    stats[f"balance_bucket_{bisect_right(BALANCE_BUCKETS, balance_cents)}"] += sign
+
+def account_matches(acc_data, locked, min_balance, max_balance):
+    return ((locked is None or bool(acc_data["locked"]) == locked)
+            and (min_balance is None or acc_data["balance_cents"] >= min_balance)
+            and (max_balance is None or acc_data["balance_cents"] <= max_balance))
+
+class ConflictError(Exception):
+    # Another process changed the account (or took the username) since it was loaded.
+    pass
+
+@timed("storage.load_data")
+def load_data(path=DATA_FILE):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"accounts": {}, "users": {}}
+
+@timed("storage.save_data")
+def save_data(data, path=DATA_FILE):
+    # Written one account per line straight from the snapshot image (see
+    # banksnapshot.SnapshotAccounts), so saving never needs a second full
+    # copy of the bank in memory; the users map is rebuilt on the way.
+    temp_file = path + ".tmp"
+    users = []
+    with open(temp_file, "w") as file:
+        file.write('{"accounts": {')
+        separator = "\n"
+        for acc_num, acc_data in data["accounts"].account_dicts():
+            file.write(f'{separator}"{acc_num}": {json.dumps(acc_data)}')
+            users.append(json.dumps({acc_data["username"]: [acc_data["password"], int(acc_num)]})[1:-1])
+            separator = ",\n"
+        file.write('\n}, "users": {' + ", ".join(users) + "}")
+        for key, value in data.items():
+            if key not in ("accounts", "users"):
+                file.write(", " + json.dumps(key) + ": " + json.dumps(value))
+        file.write("}\n")
+        file.flush()
+        count("storage.snapshot_bytes", file.tell())
+        os.fsync(file.fileno())
+    os.replace(temp_file, path)
+
+def row_from_dict(acc_data, compact=True):
+    # A plain list instead of a dict per account. compact=False leaves the
+    # entries as they were parsed, for rows that are only encoded again.
+    history = acc_data.get("transaction_history") or []
+    if compact:
+        history = [compact_entry(entry) for entry in history]
+    return [acc_data.get(field, FIELD_DEFAULTS.get(field)) for field in ACCOUNT_FIELDS] + \
+           [history, acc_data.get("history_archived", 0)]
+
+def dict_from_row(acc_num, row):
+    acc_data = dict(zip(ACCOUNT_FIELDS, row))
+    acc_data["account_number"] = int(acc_num)
+    acc_data["transaction_history"] = row[HISTORY]
+    if row[ARCHIVED]:
+        acc_data["history_archived"] = row[ARCHIVED]
+    return acc_data
+
+def apply_journal_record(data, record):
+    # Records carry the account's current fields plus the history entries
+    # written since its last record, so replaying one twice is harmless.
+    record = upgrade_account_data(dict(record))
+    start = record.pop("history_start")
+    new_entries = record.pop("transaction_history")
+    key = str(record["account_number"])
+    row = data["accounts"].get(key)
+    if row is None:
+        row = data["accounts"][key] = row_from_dict(record)
+    else:
+        row[:HISTORY] = [record.get(field, FIELD_DEFAULTS.get(field)) for field in ACCOUNT_FIELDS]
+    history = row[HISTORY]
+    del history[start:]
+    history.extend(compact_entry(entry) for entry in new_entries)
+    data["users"][record["username"]] = [record["password"], record["account_number"]]
+
+def check_record(data, record):
+    # Optimistic versioning: a record may only replace the version it was based on.
+    acc_num = int(record["account_number"])
+    row = data["accounts"].get(str(acc_num))
+    current = row[VERSION] if row else 0
+    if current != record["version"] - 1:
+        raise ConflictError(f"Account {acc_num} was changed by another process.")
+    user = data["users"].get(record["username"])
+    if user is not None and int(user[1]) != acc_num:
+        raise ConflictError(f"Username {record['username']} is already taken.")
+
+def record_events(record, was_locked, archived=0):
+    # The change-feed events (see bankfeed) of one committed record;
+    # was_locked is None when the record creates the account, archived is
+    # how many of its entries were archived (seqs count those too).
+    base = {"account_number": int(record["account_number"]), "version": record["version"],
+            "balance_cents": record["balance_cents"], "time": int(time.time())}
+    events = []
+    if was_locked is None:
+        events.append(dict(base, type="account_created", name=record["name"], username=record["username"]))
+    for seq, entry in enumerate(record["transaction_history"], archived + record["history_start"]):
+        entry = compact_entry(entry)
+        events.append(dict(base, type="transaction", time=entry.timestamp, seq=seq, kind=entry.kind,
+                           amount_cents=entry.amount, fee_cents=entry.fee, txn_id=entry.txn_id,
+                           counterparty=entry.counterparty))
+    locked = bool(record.get("locked", False))
+    if locked != bool(was_locked):  # an account created locked gets account_locked too
+        events.append(dict(base, type="account_locked" if locked else "account_unlocked"))
+    return events
+
+def journal_path_for(path):
+    # Each bank file has its own journal next to it. Banks used to share
+    # bank_journal.jsonl from the working directory, so two banks could fold
+    # each other's records in; the one of a bank_data.json is taken over once.
+    journal_path = path + ".jsonl"
+    legacy = os.path.join(os.path.dirname(path), LEGACY_JOURNAL_FILE)
+    if os.path.basename(path) == DATA_FILE and os.path.exists(legacy) and not os.path.exists(journal_path):
+        try:
+            os.rename(legacy, journal_path)
+        except FileNotFoundError:
+            pass  # another process took it over first
+    return journal_path
+
+def bump_counter(path, floor=0, count=1):
+    # Next value of a counter kept in a small file shared by every process,
+    # or the first of count values reserved together. A crash can leave a
+    # gap but never hands out a value twice, and values up to floor (already
+    # seen in the data) are skipped.
+    with open(path, "a+") as file:
+        fcntl.lockf(file, fcntl.LOCK_EX)
+        file.seek(0)
+        value = max(int(file.read() or 0), floor) + 1
+        file.truncate(0)
+        file.write(str(value + count - 1))
+        file.flush()
+    return value
+
+def snapshot_records(data):
+    for acc_data in data["accounts"].values():
+        record = dict(acc_data)
+        record["history_start"] = 0
+        record["transaction_history"] = acc_data.get("transaction_history", [])
+        yield record
+
+
+class JsonStorage:
+    # One JSON snapshot plus, optionally, an append-only journal.
+    # Several processes can share the files: account changes are guarded by
+    # byte-range locks on a lock file (byte 0 for the journal/snapshot, byte N
+    # for account N) and re-read from disk before they are applied.
+    # History older than ARCHIVE_AFTER_DAYS is moved into gzip segments under
+    # <path>.archive at checkpoints; seq numbers keep counting from the start
+    # of the account, and iter_history reads the archive when a query reaches
+    # back that far.
+    # The journal is <path>.jsonl unless journal_path says otherwise. A path
+    # ending in BINARY_SUFFIX is a memory-mapped binary snapshot (see banksnapshot).
+    # Committed changes are published to <path>.feed, or to the given
+    # EventFeed (shards share one).
+    def __init__(self, path=DATA_FILE, journal_path=None, journal=True, fsync_policy="group", txn_path=None, feed=None):
+        self.path = path
+        self.binary = path.endswith(BINARY_SUFFIX)
+        if journal_path is None:
+            journal_path = journal_path_for(path)
+        self.txn_path = txn_path or path + ".txn"  # transaction id counter, see bump_counter
+        self.allocator_path = path + ".alloc"  # account number allocator state, see bankallocator
+        self.rating_path = path + ".rating"  # periods already rated, see bankrating
+        self.data = None
+        self.journal = Journal(journal_path, fsync_policy) if journal else None
+        self.archive = HistoryArchive(path + ".archive")
+        self.feed = feed if feed is not None else EventFeed(path + ".feed")
+        self._lock_file = None
+        self._locked = set()
+        self._snapshot_id = None
+        self._checkpoint_due = False
+        self._bulk = 0  # open bulk() blocks
+        self._last_txn_id = 0
+        self._txn_index = None  # txn_id -> [(account number, seq)], built on first use
+        self._counterparty_index = None  # (account number, counterparty) -> [seq]
+        self._stats = None  # see STAT_NAMES
+        self._locked_numbers = set()
+        self._sort_indexes = {}  # ACCOUNT_SORTS name -> sorted [(value, account number)], built on first use
+
+    def load(self):
+        with self._write_lock():
+            self._load()
+        return self._image()
+
+    def refresh(self):
+        with self._write_lock():
+            self._refresh()
+
+    @contextmanager
+    def lock(self, account_numbers=()):
+        # Feed subscribers hear of the changes made inside once it is over.
+        fd = self._lock_fd()
+        acquired = []
+        with self.feed.deferring():
+            try:
+                with timer("storage.lock_wait"):
+                    for acc_num in sorted(set(int(n) for n in account_numbers) - self._locked):
+                        fcntl.lockf(fd, fcntl.LOCK_EX, 1, acc_num)
+                        self._locked.add(acc_num)
+                        acquired.append(acc_num)
+                self.refresh()
+                yield
+            finally:
+                for acc_num in acquired:
+                    fcntl.lockf(fd, fcntl.LOCK_UN, 1, acc_num)
+                    self._locked.discard(acc_num)
+        if self._checkpoint_due and self._may_checkpoint():
+            self.checkpoint()
+
+    @contextmanager
+    def bulk(self):
+        # Checkpoints falling due inside are put off to the end, so a bulk
+        # load folds the journal into the snapshot once instead of per batch.
+        self._bulk += 1
+        try:
+            yield
+        finally:
+            self._bulk -= 1
+        if self._checkpoint_due and self._may_checkpoint():
+            self.checkpoint()
+
+    def get_account(self, account_number):
+        if self.data is None:
+            self.refresh()
+        row = self.data["accounts"].get(str(account_number))
+        if row is None:
+            return None
+        return dict(dict_from_row(account_number, row), history_count=len(row[HISTORY]))
+
+    def get_history(self, account_number):
+        return self.data["accounts"][str(account_number)][HISTORY]
+
+    def iter_history(self, account_number, since=None, until=None, before=None, newest_first=False, counterparty=None):
+        # (seq, entry) pairs with since <= timestamp < until and seq < before,
+        # optionally only the legs with one counterparty. History is appended
+        # in time order, so the time range is found by binary search and the
+        # counterparty through an index instead of a scan. The archive is only
+        # opened when the range reaches back past the hot history.
+        row = self.data["accounts"][str(account_number)]
+        history, base = row[HISTORY], row[ARCHIVED]
+        start = 0 if since is None else bisect_left(history, since, key=entry_time)
+        stop = len(history) if until is None else bisect_left(history, until, key=entry_time)
+        if before is not None:
+            stop = min(stop, before - base)
+        if counterparty is None:
+            seqs = range(start, stop)
+        else:
+            self._build_indexes()
+            indexed = self._counterparty_index.get((int(account_number), counterparty), [])
+            seqs = indexed[bisect_left(indexed, start):bisect_left(indexed, stop)]
+        hot = ((base + seq, history[seq]) for seq in (reversed(seqs) if newest_first else seqs))
+        if not base or start > 0:
+            yield from hot
+            return
+        archived = self._iter_archive(account_number, base, since, until, before, counterparty)
+        if newest_first:
+            yield from hot
+            yield from reversed(list(archived))  # one account's archived entries
+        else:
+            yield from archived
+            yield from hot
+
+    def find_transaction(self, txn_id):
+        # Every leg of one transaction as (account number, seq, entry). Only
+        # hot history is indexed; archived legs are found through iter_history.
+        if self.data is None:
+            self.refresh()
+        self._build_indexes()
+        legs = []
+        for acc_num, seq in self._txn_index.get(txn_id, []):
+            row = self.data["accounts"][str(acc_num)]
+            legs.append((acc_num, row[ARCHIVED] + seq, row[HISTORY][seq]))
+        return legs
+
+    def next_txn_id(self, count=1):
+        # The first of count new ids.
+        return bump_counter(self.txn_path, self._last_txn_id, count)
+
+    def load_with_archive(self):
+        # Like load(), but with archived entries put back in front of each
+        # history; for copying the whole bank into another storage.
+        data = self.load()
+        for acc_num, acc_data in data["accounts"].items():
+            archived = self.archive.read(acc_num, acc_data.pop("history_archived", 0))
+            acc_data["transaction_history"] = [compact_entry(entry) for seq, entry in archived] + acc_data["transaction_history"]
+        return data
+
+    def find_user(self, username):
+        if self.data is None:
+            self.refresh()
+        return self.data["users"].get(username)
+
+    def account_numbers(self):
+        if self.data is None:
+            self.refresh()
+        return [int(acc_num) for acc_num in self.data["accounts"]]
+
+    def count(self):
+        if self.data is None:
+            self.refresh()
+        return len(self.data["accounts"])
+
+    def iter_accounts(self, sort=None, descending=False, after=None, locked=None, min_balance=None, max_balance=None):
+        # Accounts without their history (but with history_count, as in
+        # get_account), one at a time: in storage order, or
+        # by an ACCOUNT_SORTS key starting past the after key (value, account
+        # number). Sorted reads walk a sorted index (the locked accounts are
+        # a set of their own) and bisect to the balance range and the cursor.
+        if self.data is None:
+            self.refresh()
+        accounts = self.data["accounts"]
+        if sort is None:
+            keys = [(None, int(acc_num)) for acc_num in list(accounts)]
+        elif locked:
+            keys = sorted(self._sort_key(sort, acc_num) for acc_num in self._locked_numbers)
+        else:
+            keys = self._sort_index(sort)
+        low, high = 0, len(keys)
+        if sort == "balance":
+            if min_balance is not None:
+                low = bisect_left(keys, (min_balance,))
+            if max_balance is not None:
+                high = bisect_left(keys, (max_balance + 1,))
+        if after is not None:
+            if descending:
+                high = min(high, bisect_left(keys, tuple(after)))
+            else:
+                low = max(low, bisect_right(keys, tuple(after)))
+        for position in range(high - 1, low - 1, -1) if descending else range(low, high):
+            acc_num = keys[position][1]
+            acc_data = dict_from_row(acc_num, accounts.peek(str(acc_num)))
+            acc_data["history_count"] = len(acc_data.pop("transaction_history"))
+            if account_matches(acc_data, locked, min_balance, max_balance):
+                yield acc_data
+
+    def balances(self):
+        # (account number, balance) of every account, read from the
+        # snapshot's table without building account dicts.
+        if self.data is None:
+            self.refresh()
+        return self.data["accounts"].balances()
+
+    def stats(self):
+        if self.data is None:
+            self.refresh()
+        return dict(self._stats)
+
+    def write_binary(self, path):
+        # Writes the current state as a binary snapshot at path.
+        from banksnapshot import save_snapshot  # banksnapshot builds on this module
+        with self._write_lock():
+            self._refresh()
+            save_snapshot(self.data, path, self._snapshot_meta())
+
+    def write(self, records, check=True):
+        # Merge-on-save: only the given accounts are applied on top of the
+        # latest state on disk, and only if nobody else changed them first.
+        records = list(records)
+        with self._write_lock():
+            self._refresh()
+            if check:
+                self._check(records)
+            # Unchecked writes copy accounts in from elsewhere; they are not changes.
+            self._commit(records, publish=check)
+        if self._checkpoint_due and self._may_checkpoint():
+            self.checkpoint()
+
+    def checkpoint(self, archive_before=None):
+        # Folding the journal needs every other process out of the way, so it
+        # takes the whole lock file; while this process still holds account
+        # locks (or is inside bulk()) the checkpoint is put off. Once every
+        # COMPACT_EVERY seconds (or when archive_before, a timestamp, is given)
+        # older history is moved to the archive on the way.
+        if not self._may_checkpoint():
+            self._checkpoint_due = True
+            return
+        fd = self._lock_fd()
+        fcntl.lockf(fd, fcntl.LOCK_EX, 0, 0)
+        try:
+            self._refresh()
+            if archive_before is None and time.time() - self.data.get("compacted_at", 0) >= COMPACT_EVERY:
+                archive_before = int(time.time()) - ARCHIVE_AFTER_DAYS * 24 * 3600
+            if archive_before is not None:
+                self._archive_history(archive_before)
+            self._save_snapshot()
+            if self.journal is not None:
+                self.journal.truncate()
+            if self.binary:
+                self._load()  # maps the new file, dropping the rows decoded since the last one
+            else:
+                self._compact()
+            self._checkpoint_due = False
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 0, 0)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.feed.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _may_checkpoint(self):
+        return not self._locked and not self._bulk
+
+    def _lock_fd(self):
+        if self._lock_file is None:
+            self._lock_file = open(self.path + ".lock", "a+")
+        return self._lock_file.fileno()
+
+    @contextmanager
+    def _write_lock(self):
+        fd = self._lock_fd()
+        with self.feed.deferring():
+            with timer("storage.write_lock_wait"):
+                fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                yield
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+
+    def _file_id(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def _load(self):
+        self._snapshot_id = self._file_id()
+        self._txn_index = self._counterparty_index = None
+        self._sort_indexes = {}
+        if self.binary:
+            self._load_binary()
+        else:
+            self._load_json()
+        if self.journal is not None:
+            self.journal.reset()
+            self._replay()
+
+    def _load_binary(self):
+        # The totals, locked accounts and last txn id are stored with the
+        # snapshot; nothing else is read until it is asked for.
+        from banksnapshot import load_snapshot
+        self.data, meta = load_snapshot(self.path)
+        self._stats = dict(dict.fromkeys(STAT_NAMES, 0), **meta.get("stats", {}))
+        self._locked_numbers = set(meta.get("locked", []))
+        self._last_txn_id = meta.get("last_txn_id", 0)
+
+    def _load_json(self):
+        # Parsed into rows, then packed into a snapshot image (see
+        # banksnapshot.compact) that the rows are decoded from again on use.
+        data = load_data(self.path)
+        accounts = data["accounts"]
+        self._last_txn_id = 0
+        self._stats = dict.fromkeys(STAT_NAMES, 0)
+        self._locked_numbers = set()
+        for acc_num in accounts:
+            row = accounts[acc_num] = row_from_dict(upgrade_account_data(accounts[acc_num]), compact=False)
+            count_account(self._stats, row[BALANCE], row[LOCKED])
+            if row[LOCKED]:
+                self._locked_numbers.add(int(acc_num))
+            if row[HISTORY]:
+                # Ids only grow, so the newest entry holds the account's highest.
+                self._index_entry(int(acc_num), len(row[HISTORY]) - 1, compact_entry(row[HISTORY][-1]))
+        self.data = data
+        self._compact()
+
+    def _compact(self):
+        # Packs the rows decoded since the last time back into the image.
+        from banksnapshot import compact
+        self.data["accounts"], self.data["users"] = compact(self.data)
+
+    def _refresh(self):
+        # A new snapshot means another process checkpointed: start over.
+        # Otherwise only the journal lines appended since the last look are read.
+        if self.data is None or self._file_id() != self._snapshot_id:
+            self._load()
+        elif self.journal is not None:
+            self._replay()
+
+    def _replay(self):
+        for line in self.journal.replay():
+            # A journal line is the list of records written together.
+            for record in line if isinstance(line, list) else [line]:
+                self._apply(record)
+
+    def _apply(self, record):
+        acc_num = int(record["account_number"])
+        row = self.data["accounts"].get(str(acc_num))
+        before = row and (row[BALANCE], row[LOCKED])
+        apply_journal_record(self.data, record)
+        history = self.get_history(acc_num)
+        start = record["history_start"]
+        for seq in range(start, len(history)):
+            self._index_entry(acc_num, seq, history[seq])
+        row = self.data["accounts"][str(acc_num)]
+        if before != (row[BALANCE], row[LOCKED]):
+            self._index_account(acc_num, before, row)
+
+    def _index_account(self, acc_num, before, row):
+        # Moves the account within the totals and sort indexes; before is
+        # its old (balance, locked), or None for a new account.
+        if before:
+            count_account(self._stats, *before, sign=-1)
+        count_account(self._stats, row[BALANCE], row[LOCKED])
+        if row[LOCKED]:
+            self._locked_numbers.add(acc_num)
+        else:
+            self._locked_numbers.discard(acc_num)
+        keys = self._sort_indexes.get("balance")
+        if keys is not None:
+            if before:
+                del keys[bisect_left(keys, (before[0], acc_num))]
+            insort(keys, (row[BALANCE], acc_num))
+        keys = self._sort_indexes.get("account_number")
+        if keys is not None and not before:
+            insort(keys, (acc_num, acc_num))
+
+    def _sort_key(self, sort, acc_num):
+        return (self.data["accounts"][str(acc_num)][BALANCE] if sort == "balance" else acc_num), acc_num
+
+    def _sort_index(self, sort):
+        keys = self._sort_indexes.get(sort)
+        if keys is None:
+            accounts = self.data["accounts"]
+            if sort == "balance":
+                # Straight from the snapshot's table, without decoding the accounts.
+                keys = sorted((balance, acc_num) for acc_num, balance in accounts.balances())
+            else:
+                keys = sorted(self._sort_key(sort, int(acc_num)) for acc_num in accounts)
+            self._sort_indexes[sort] = keys
+        return keys
+
+    def _index_entry(self, acc_num, seq, entry):
+        if entry.txn_id is not None and entry.txn_id > self._last_txn_id:
+            self._last_txn_id = entry.txn_id
+        if self._txn_index is None:
+            return
+        if entry.txn_id is not None:
+            legs = self._txn_index.setdefault(entry.txn_id, [])
+            if (acc_num, seq) not in legs:
+                legs.append((acc_num, seq))
+        if entry.counterparty is not None:
+            seqs = self._counterparty_index.setdefault((acc_num, entry.counterparty), [])
+            if not seqs or seqs[-1] < seq:
+                seqs.append(seq)
+
+    def _build_indexes(self):
+        if self._txn_index is not None:
+            return
+        self._txn_index = {}
+        self._counterparty_index = {}
+        for acc_num, row in self.data["accounts"].items():
+            for seq, entry in enumerate(row[HISTORY]):
+                self._index_entry(int(acc_num), seq, entry)
+
+    def _image(self):
+        accounts = {acc_num: dict_from_row(acc_num, row) for acc_num, row in self.data["accounts"].items()}
+        users = {acc_data["username"]: [acc_data["password"], int(acc_num)] for acc_num, acc_data in accounts.items()}
+        return {"accounts": accounts, "users": users}
+
+    def _check(self, records):
+        for record in records:
+            check_record(self.data, record)
+
+    def _commit(self, records, publish=True):
+        # Callers hold the write lock and have refreshed and checked; the
+        # feed is written under the same lock, once the journal has the
+        # records, so it is in commit order.
+        if self.journal is not None:
+            self.journal.append(records)
+        events = []
+        for record in records:
+            if publish:
+                row = self.data["accounts"].get(str(int(record["account_number"])))
+                if row is None:
+                    events += record_events(record, None)
+                else:
+                    events += record_events(record, row[LOCKED], row[ARCHIVED])
+            self._apply(record)
+        self.feed.publish(events)
+        if self.journal is None:
+            self._save_snapshot()
+        elif self.journal.records >= CHECKPOINT_EVERY:
+            self._checkpoint_due = True
+
+    def _iter_archive(self, account_number, base, since, until, before, counterparty):
+        stop = base if before is None else min(base, before)
+        for seq, entry in self.archive.read(account_number, stop):
+            entry = compact_entry(entry)
+            if since is not None and entry_time(entry) < since:
+                continue
+            if until is not None and entry_time(entry) >= until:
+                break
+            if counterparty is None or entry.counterparty == counterparty:
+                yield seq, entry
+
+    def _archive_history(self, cutoff):
+        # Entries older than cutoff go into one new archive segment; each
+        # account keeps its hot tail and counts the entries moved. The segment
+        # is on disk before the snapshot that drops the entries, and versions
+        # are bumped so processes holding the old history must reload it.
+        archived = []
+        for acc_num, row in self.data["accounts"].items():
+            split = bisect_left(row[HISTORY], cutoff, key=entry_time)
+            if split:
+                archived.append((int(acc_num), row[ARCHIVED], row[HISTORY][:split]))
+        if self.archive.write_segment(time.strftime("%Y-%m-%d", time.localtime(cutoff)), archived) is not None:
+            for acc_num, first_seq, entries in archived:
+                row = self.data["accounts"][str(acc_num)]
+                row[ARCHIVED] += len(entries)
+                del row[HISTORY][:len(entries)]
+                row[VERSION] += 1
+            self._txn_index = self._counterparty_index = None
+        self.data["compacted_at"] = int(time.time())
+
+    def _save_snapshot(self):
+        if self.binary:
+            from banksnapshot import save_snapshot
+            save_snapshot(self.data, self.path, self._snapshot_meta())
+        else:
+            save_data(self.data, self.path)
+        self._snapshot_id = self._file_id()
+
+    def _snapshot_meta(self):
+        return {"stats": self._stats, "locked": sorted(self._locked_numbers), "last_txn_id": self._last_txn_id}
+
+
+class SqliteStorage:
+    # Normalized tables; every write only touches the rows of the given accounts.
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self.allocator_path = path + ".alloc"
+        self.rating_path = path + ".rating"
+        self.feed = EventFeed(path + ".feed")
+        self._events = []  # feed events of the open transaction, see lock
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS accounts (
+                account_number INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                username TEXT NOT NULL,
+                password TEXT NOT NULL,
+                pin TEXT NOT NULL,
+                balance_cents INTEGER NOT NULL,
+                locked INTEGER NOT NULL DEFAULT 0,
+                login_attempts INTEGER NOT NULL DEFAULT 0,
+                pin_attempts INTEGER NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                password TEXT NOT NULL,
+                account_number INTEGER NOT NULL REFERENCES accounts(account_number)
+            );
+            CREATE TABLE IF NOT EXISTS transactions (
+                account_number INTEGER NOT NULL REFERENCES accounts(account_number),
+                seq INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                amount_cents INTEGER NOT NULL,
+                fee_cents INTEGER NOT NULL DEFAULT 0,
+                timestamp INTEGER,
+                txn_id INTEGER,
+                counterparty INTEGER,
+                PRIMARY KEY (account_number, seq)
+            );
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS accounts_username ON accounts(username);
+            CREATE INDEX IF NOT EXISTS users_account_number ON users(account_number);
+        """)
+        if "version" not in [row[1] for row in self.conn.execute("PRAGMA table_info(accounts)")]:
+            self.conn.execute("ALTER TABLE accounts ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self._upgrade_money_columns()
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(transactions)")]
+        for column in ("timestamp", "txn_id", "counterparty"):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE transactions ADD COLUMN {column} INTEGER")
+        self.conn.executescript("""
+            CREATE INDEX IF NOT EXISTS transactions_time ON transactions(account_number, timestamp);
+            CREATE INDEX IF NOT EXISTS transactions_txn ON transactions(txn_id);
+            CREATE INDEX IF NOT EXISTS transactions_counterparty ON transactions(counterparty, account_number);
+            INSERT OR IGNORE INTO counters (name, value) VALUES ('txn_id', 0);
+            CREATE INDEX IF NOT EXISTS accounts_balance ON accounts(balance_cents, account_number);
+            CREATE INDEX IF NOT EXISTS accounts_locked ON accounts(account_number) WHERE locked;
+        """)
+        if self.conn.execute("SELECT 1 FROM counters WHERE name = 'accounts'").fetchone() is None:
+            # The admin totals live in counters too; counted once for a
+            # database that predates them, then updated by every write.
+            stats = dict.fromkeys(STAT_NAMES, 0)
+            for balance_cents, locked in self.conn.execute("SELECT balance_cents, locked FROM accounts"):
+                count_account(stats, balance_cents, locked)
+            with self.conn:
+                self.conn.executemany("INSERT OR IGNORE INTO counters (name, value) VALUES (?, ?)", stats.items())
+
+    def load(self):
+        data = {"accounts": {}, "users": {}}
+        for row in self.conn.execute("SELECT account_number, " + ", ".join(ACCOUNT_FIELDS) + " FROM accounts"):
+            acc_data = self._account_from_row(row)
+            acc_data["transaction_history"] = []
+            data["accounts"][str(row[0])] = acc_data
+        for row in self.conn.execute("SELECT account_number, " + ENTRY_COLUMNS + " FROM transactions ORDER BY account_number, seq"):
+            data["accounts"][str(row[0])]["transaction_history"].append(self._entry_from_row(row[1:]))
+        for username, password, acc_num in self.conn.execute("SELECT username, password, account_number FROM users"):
+            data["users"][username] = [password, acc_num]
+        return data
+
+    def get_account(self, account_number):
+        row = self.conn.execute(
+            "SELECT account_number, " + ", ".join(ACCOUNT_FIELDS) + " FROM accounts WHERE account_number = ?",
+            (account_number,)).fetchone()
+        if row is None:
+            return None
+        acc_data = self._account_from_row(row)
+        acc_data["history_count"] = self.conn.execute(
+            "SELECT COUNT(*) FROM transactions WHERE account_number = ?", (account_number,)).fetchone()[0]
+        return acc_data
+
+    def get_history(self, account_number):
+        return [self._entry_from_row(row) for row in self.conn.execute(
+            "SELECT " + ENTRY_COLUMNS + " FROM transactions WHERE account_number = ? ORDER BY seq", (account_number,))]
+
+    def iter_history(self, account_number, since=None, until=None, before=None, newest_first=False, counterparty=None):
+        # Same contract as JsonStorage.iter_history; the time range and the
+        # counterparty use their indexes and rows are streamed from the cursor.
+        query = "SELECT seq, " + ENTRY_COLUMNS + " FROM transactions WHERE account_number = ?"
+        params = [account_number]
+        if counterparty is not None:
+            query += " AND counterparty = ?"
+            params.append(counterparty)
+        if since is not None:
+            query += " AND timestamp >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND (timestamp < ? OR timestamp IS NULL)"
+            params.append(until)
+        if before is not None:
+            query += " AND seq < ?"
+            params.append(before)
+        query += " ORDER BY seq DESC" if newest_first else " ORDER BY seq"
+        for row in self.conn.execute(query, params):
+            yield row[0], self._entry_from_row(row[1:])
+
+    def find_transaction(self, txn_id):
+        return [(row[0], row[1], self._entry_from_row(row[2:])) for row in self.conn.execute(
+            "SELECT account_number, seq, " + ENTRY_COLUMNS + " FROM transactions WHERE txn_id = ? ORDER BY account_number, seq",
+            (txn_id,))]
+
+    def next_txn_id(self, count=1):
+        # Also skips past any ids already in the table (e.g. after a migration);
+        # MAX(txn_id) is a single lookup in the transactions_txn index.
+        with self.lock():
+            self.conn.execute("UPDATE counters SET value = MAX(value, (SELECT COALESCE(MAX(txn_id), 0) FROM transactions)) + ? "
+                              "WHERE name = 'txn_id'", (count,))
+            return self.conn.execute("SELECT value FROM counters WHERE name = 'txn_id'").fetchone()[0] - count + 1
+
+    def find_user(self, username):
+        row = self.conn.execute("SELECT password, account_number FROM users WHERE username = ?", (username,)).fetchone()
+        return list(row) if row else None
+
+    def account_numbers(self):
+        return [row[0] for row in self.conn.execute("SELECT account_number FROM accounts ORDER BY account_number")]
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
+
+    def iter_accounts(self, sort=None, descending=False, after=None, locked=None, min_balance=None, max_balance=None):
+        # Served by the primary key, accounts_balance or the partial
+        # accounts_locked index; after is a (value, account number) key.
+        conditions, params = [], []
+        if locked is not None:
+            conditions.append("locked" if locked else "NOT locked")
+        if min_balance is not None:
+            conditions.append("balance_cents >= ?")
+            params.append(min_balance)
+        if max_balance is not None:
+            conditions.append("balance_cents <= ?")
+            params.append(max_balance)
+        column = ACCOUNT_SORTS[sort or "account_number"]
+        if after is not None:
+            conditions.append(f"({column}, account_number) {'<' if descending else '>'} (?, ?)")
+            params += after
+        direction = "DESC" if descending else "ASC"
+        # MAX(seq) is one lookup in the transactions primary key per account.
+        query = ("SELECT account_number, " + ", ".join(ACCOUNT_FIELDS) + ", (SELECT COALESCE(MAX(seq) + 1, 0) FROM transactions "
+                 "WHERE transactions.account_number = accounts.account_number) FROM accounts"
+                 + (" WHERE " + " AND ".join(conditions) if conditions else "")
+                 + f" ORDER BY {column} {direction}, account_number {direction}")
+        # A separate cursor, so writes on self.conn can go on while it is read.
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        for row in cursor:
+            acc_data = self._account_from_row(row[:-1])
+            acc_data["history_count"] = row[-1]
+            yield acc_data
+
+    def balances(self):
+        return self.conn.execute("SELECT account_number, balance_cents FROM accounts")
+
+    def stats(self):
+        placeholders = ", ".join("?" * len(STAT_NAMES))
+        return dict(self.conn.execute(f"SELECT name, value FROM counters WHERE name IN ({placeholders})", STAT_NAMES))
+
+    @contextmanager
+    def lock(self, account_numbers=()):
+        # SQLite reads are always current, so locking is one IMMEDIATE
+        # transaction that the writes inside it join. Their feed events are
+        # published once it has committed; the feed is held from just before
+        # COMMIT, so the next writer's events still come after them.
+        if self.conn.in_transaction:
+            yield
+            return
+        with self.feed.deferring():
+            with timer("storage.lock_wait"):
+                self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.rollback()
+                self._events = []
+                raise
+            events, self._events = self._events, []
+            if not events:
+                self.conn.commit()
+                return
+            with self.feed.hold():
+                self.conn.commit()
+                self.feed.publish(events)
+
+    def refresh(self):
+        pass
+
+    def write(self, records, check=True):
+        # The events wait in self._events for the surrounding transaction
+        # to commit (see lock).
+        with self.lock():
+            for record in records:
+                was_locked = self._write_record(record, check)
+                if check:
+                    self._events += record_events(record, was_locked)
+
+    def checkpoint(self):
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def bulk(self):
+        return nullcontext()  # nothing to put off
+
+    def close(self):
+        self.conn.close()
+        self.feed.close()
+
+    def _account_from_row(self, row):
+        acc_data = dict(zip(("account_number",) + ACCOUNT_FIELDS, row))
+        acc_data["locked"] = bool(acc_data["locked"])
+        acc_data["balance_cents"] = int(acc_data["balance_cents"])
+        return acc_data
+
+    def _entry_from_row(self, row):
+        tx_type, amount, fee, timestamp, txn_id, counterparty = row
+        return make_entry(tx_type, int(amount), int(fee), timestamp, txn_id, counterparty)
+
+    def _upgrade_money_columns(self):
+        # Databases created before money was kept in cents have REAL dollar
+        # columns; rename them and convert the values once.
+        for table, columns in (("accounts", ("balance",)), ("transactions", ("amount", "fee"))):
+            existing = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+            for column in columns:
+                if column in existing:
+                    with self.conn:
+                        self.conn.execute(f"ALTER TABLE {table} RENAME COLUMN {column} TO {column}_cents")
+                        self.conn.execute(f"UPDATE {table} SET {column}_cents = CAST(ROUND({column}_cents * 100) AS INTEGER)")
+
+    def _write_record(self, record, check=True):
+        acc_num = int(record["account_number"])
+        before = self.conn.execute("SELECT version, balance_cents, locked FROM accounts WHERE account_number = ?",
+                                   (acc_num,)).fetchone()
+        if check:
+            if (before[0] if before else 0) != record["version"] - 1:
+                raise ConflictError(f"Account {acc_num} was changed by another process.")
+            row = self.conn.execute("SELECT account_number FROM users WHERE username = ?", (record["username"],)).fetchone()
+            if row is not None and row[0] != acc_num:
+                raise ConflictError(f"Username {record['username']} is already taken.")
+        self.conn.execute(
+            "INSERT OR REPLACE INTO accounts (account_number, " + ", ".join(ACCOUNT_FIELDS) + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (acc_num,) + tuple(record.get(field, 0) for field in ACCOUNT_FIELDS))
+        self.conn.execute("INSERT OR REPLACE INTO users (username, password, account_number) VALUES (?, ?, ?)",
+                          (record["username"], record["password"], acc_num))
+        start = record["history_start"]
+        self.conn.execute("DELETE FROM transactions WHERE account_number = ? AND seq >= ?", (acc_num, start))
+        self.conn.executemany(
+            "INSERT INTO transactions (account_number, seq, " + ENTRY_COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(acc_num, start + i) + tuple(compact_entry(entry))
+             for i, entry in enumerate(record["transaction_history"])])
+        after = (record["balance_cents"], bool(record.get("locked", False)))
+        if before is None or (before[1], bool(before[2])) != after:
+            changes = dict.fromkeys(STAT_NAMES, 0)
+            if before is not None:
+                count_account(changes, before[1], before[2], sign=-1)
+            count_account(changes, *after)
+            self.conn.executemany("UPDATE counters SET value = value + ? WHERE name = ?",
+                                  [(change, name) for name, change in changes.items() if change])
+        return None if before is None else bool(before[2])
+
+
+def open_storage(path=None, shards=None, journal=True):
+    # The storage a bank path names: a directory (or any path, when a shard
+    # count is given) is a shard directory, see bankshard; a .json or .bin
+    # file is a JsonStorage; anything else is a SQLite database. No path is
+    # the default bank_data.json.
+    if path is None:
+        return JsonStorage(journal=journal)
+    if shards is not None or os.path.isdir(path):
+        from bankshard import ShardedStorage  # bankshard builds on this module
+        return ShardedStorage(path, shards, journal)
+    if path.endswith((".json", BINARY_SUFFIX)):
+        return JsonStorage(path, journal=journal)
+    return SqliteStorage(path)
+
+def migrate_json_to_sqlite(json_path=DATA_FILE, db_path=DB_FILE, journal_path=None):
+    source = JsonStorage(json_path, journal_path)
+    data = source.load_with_archive()
+    source.close()
+    target = SqliteStorage(db_path)
+    target.write(snapshot_records(data), check=False)
+    target.close()
+    return len(data["accounts"])
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        count = migrate_json_to_sqlite(*sys.argv[2:4])
+        print(f"Migrated {count} accounts.")
+    elif len(sys.argv) >= 3 and sys.argv[1] == "archive":
+        # Moves history older than the given number of days to the archive now.
+        storage = JsonStorage(*sys.argv[3:4])
+        storage.checkpoint(archive_before=int(time.time()) - int(sys.argv[2]) * 24 * 3600)
+        storage.close()
+        print(f"Archived history older than {sys.argv[2]} days.")
+    else:
+        print("Usage: python bankstorage.py migrate [bank_data.json] [bank_data.db]")
+        print("       python bankstorage.py archive DAYS [bank_data.json]")
+        sys.exit(1)
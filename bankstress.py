@@ -0,0 +1,72 @@
+from bankcore import Bank, BankError
+from bankmoney import format_money
+from banksecurity import hash_secret
+from bankstorage import open_storage
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+
+# Several processes transfer money between the same accounts at once.
+# Afterwards every cent must still be either in a balance or in a fee.
+ACCOUNTS = 20
+PROCESSES = 4
+TRANSFERS = 200
+INITIAL_BALANCE = 1000
+SHARD_COUNT = 4
+STORAGE_KINDS = ("journal", "snapshot", "binary", "sqlite", "sharded")
+
+# The file each kind of storage keeps a bank in; "snapshot" is a JSON file
+# rewritten whole on every write, with no journal.
+STORAGE_FILES = {"journal": "bank.json", "snapshot": "bank.json", "binary": "bank.bin", "sqlite": "bank.db", "sharded": "shards"}
+
+def make_storage(kind, directory, shards=SHARD_COUNT):
+    return open_storage(os.path.join(directory, STORAGE_FILES[kind]), shards if kind == "sharded" else None,
+                        journal=(kind != "snapshot"))
+
+def total_money(bank):
+    balances = fees = 0
+    for number in bank.storage.account_numbers():
+        balances += bank.balance(number)
+        fees += sum(entry[2] for seq, entry in bank.statement(number, kinds=["Transfer Fee"]))
+    return balances + fees
+
+def worker(kind, directory, seed):
+    bank = Bank(make_storage(kind, directory), lazy=True)
+    numbers = bank.storage.account_numbers()
+    rng = random.Random(seed)
+    for _ in range(TRANSFERS):
+        sender_number, recipient_number = rng.sample(numbers, 2)
+        try:
+            bank.transfer(sender_number, recipient_number, rng.randint(1, 20), "1234")
+        except BankError:
+            pass
+    bank.close()
+
+def run(kind):
+    with tempfile.TemporaryDirectory() as directory:
+        bank = Bank(make_storage(kind, directory))
+        password, pin = hash_secret("secret"), hash_secret("1234")  # once, not per account
+        for i in range(ACCOUNTS):
+            bank.create_account(f"User {i}", f"user{i}", password, pin, INITIAL_BALANCE, hashed=True)
+        bank.close()
+
+        processes = [multiprocessing.Process(target=worker, args=(kind, directory, seed)) for seed in range(PROCESSES)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        bank = Bank(make_storage(kind, directory))
+        expected = ACCOUNTS * INITIAL_BALANCE * 100
+        found = total_money(bank)
+        bank.close()
+        failed = [process for process in processes if process.exitcode != 0]
+        ok = not failed and found == expected
+        print(f"{kind}: expected ${format_money(expected)}, found ${format_money(found)} - {'OK' if ok else 'FAILED'}")
+        return ok
+
+if __name__ == "__main__":
+    results = [run(kind) for kind in (sys.argv[1:] or STORAGE_KINDS)]
+    sys.exit(0 if all(results) else 1)